@@ -0,0 +1,126 @@
+"""
+Web app to provide feedback from and to students and teachers.
+Author: Joseph Grace
+A load benchmark of database writes, comparing the SQLite settings the app used before WAL with the current ones.
+Worker processes post comments on one project while loading its page, through the app's own routes,
+each against a fresh database file, and the throughput, latency and errors of each setting are reported.
+
+Usage: python benchmark_database.py [processes] [seconds]
+Extra settings can be compared by adding them to SETTINGS.
+"""
+
+import os
+import sys
+import json
+import time
+import tempfile
+import subprocess
+import multiprocessing
+
+
+#Settings compared, as environment variables read by constants.py.
+#Before, each connection used SQLite's defaults and the 5 second timeout of Python's sqlite3 module.
+SETTINGS = [
+    ("Rollback journal (before)", {"SQLITE_JOURNAL_MODE": "DELETE", "SQLITE_SYNCHRONOUS": "FULL", "SQLITE_BUSY_TIMEOUT": "5000"}),
+    ("WAL (current defaults)", {}),
+]
+
+
+def percentile(values, fraction):
+    """Returns the value below which the given fraction of values fall, or 0 if there are none."""
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+
+def run_worker(worker_index, project_id, deadline, results):
+    """Posts comments and loads the project page until deadline, recording the latency of each request."""
+    from web_app import app, db
+
+    #Connections opened before the fork belong to the parent.
+    with app.app_context():
+        db.engine.dispose()
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["_user_id"] = f"bench_{worker_index}"
+        session["_fresh"] = True
+    writes, reads, errors = [], [], []
+    count = 0
+    while time.time() < deadline:
+        count += 1
+        start = time.perf_counter()
+        response = client.post(f"/project/{project_id}/comment", data={"text": f"Comment {count} from {worker_index}"})
+        (writes if response.status_code == 200 else errors).append(time.perf_counter() - start)
+        start = time.perf_counter()
+        response = client.get(f"/project/{project_id}")
+        (reads if response.status_code == 200 else errors).append(time.perf_counter() - start)
+    results.put((writes, reads, len(errors)))
+
+
+
+def run_setting(processes, seconds):
+    """Runs the benchmark under the settings in the environment, printing its results as JSON."""
+    from web_app import app, db, Users, create_project
+    from access_names import CAN_COMMENT
+
+    with app.app_context():
+        for worker_index in range(processes):
+            db.session.add(Users(user_id=f"bench_{worker_index}", name=f"Benchmark {worker_index}",
+                                 email=f"bench_{worker_index}@example.com", profile_pic_url=""))
+        db.session.commit()
+        project = create_project("Benchmark", "bench_0", default_access=CAN_COMMENT)
+        db.session.commit()
+        project_id = project.project_id
+        db.session.remove()
+        db.engine.dispose()
+
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    deadline = time.time() + seconds
+    workers = [context.Process(target=run_worker, args=(worker_index, project_id, deadline, results))
+               for worker_index in range(processes)]
+    for worker in workers:
+        worker.start()
+    writes, reads, errors = [], [], 0
+    for worker in workers:
+        worker_writes, worker_reads, worker_errors = results.get()
+        writes += worker_writes
+        reads += worker_reads
+        errors += worker_errors
+    for worker in workers:
+        worker.join()
+    print(json.dumps({"writes_per_second": len(writes) / seconds,
+                      "reads_per_second": len(reads) / seconds,
+                      "write_p95_ms": percentile(writes, 0.95) * 1000,
+                      "read_p95_ms": percentile(reads, 0.95) * 1000,
+                      "errors": errors}))
+
+
+
+def main():
+    processes = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    print(f"{processes} processes for {seconds:g} seconds each")
+    print(f"{'Setting':<28}{'writes/s':>10}{'reads/s':>10}{'write p95':>12}{'read p95':>12}{'errors':>8}")
+    for name, setting in SETTINGS:
+        with tempfile.TemporaryDirectory() as folder:
+            environment = dict(os.environ, **setting)
+            environment["DATABASE_URL"] = "sqlite:///" + os.path.join(folder, "benchmark.db")
+            #The page cache would otherwise answer most page loads.
+            environment["PAGE_CACHE_FOLDER"] = ""
+            environment["PAGE_CACHE_MAX_BYTES"] = "0"
+            output = subprocess.run([sys.executable, __file__, "--run", str(processes), str(seconds)],
+                                    env=environment, capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(f"{name:<28}{result['writes_per_second']:>10.1f}{result['reads_per_second']:>10.1f}"
+              f"{result['write_p95_ms']:>10.1f}ms{result['read_p95_ms']:>10.1f}ms{result['errors']:>8}")
+
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--run":
+        run_setting(int(sys.argv[2]), float(sys.argv[3]))
+    else:
+        main()
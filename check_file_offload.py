@@ -0,0 +1,252 @@
+"""
+Web app to provide feedback from and to students and teachers.
+Author: Joseph Grace
+Checks how downloads and WebGL build files are sent in each FILE_OFFLOAD mode, through the app's routes:
+sent by the worker, handed to nginx with X-Accel-Redirect, or handed to Apache or lighttpd with X-Sendfile.
+If nginx is installed, it is then run with nginx_offload.conf in front of the app,
+and files are fetched through it, including range and conditional requests.
+A fresh database and storage folder are made in a temporary folder, so the app's own files are untouched.
+
+Usage: python check_file_offload.py [path to nginx]
+"""
+
+import io
+import os
+import sys
+import time
+import shutil
+import socket
+import zipfile
+import tempfile
+import threading
+import subprocess
+import http.cookiejar
+import urllib.request
+import urllib.error
+
+from urllib.parse import unquote, urlencode
+
+
+DOWNLOAD_DATA = b"0123456789" * 10000
+BUILD_DATA = b"compressed data" * 1000
+
+
+def check(condition, description):
+    """Prints whether a check passed, and raises AssertionError if it did not."""
+    print(f"{'ok  ' if condition else 'FAIL'} {description}")
+    if not condition:
+        raise AssertionError(description)
+
+
+
+def make_project(app, folder):
+    """
+    Makes a public project with a download and a WebGL build with a brotli compressed file,
+    uploaded through the app's routes. Returns a 2-tuple (project id, build version).
+    """
+    from web_app import db, Users, Projects, ExtractionJobs, create_project
+    from access_names import CAN_VIEW
+
+    with app.app_context():
+        db.session.add(Users(user_id="owner", name="Owner", email="owner@example.com", profile_pic_url=""))
+        project = create_project("Offload", "owner", default_access=CAN_VIEW)
+        db.session.commit()
+        project_id = project.project_id
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["_user_id"] = "owner"
+        session["_fresh"] = True
+    response = client.post(f"/project/{project_id}/upload/download",
+                           data={"file": (io.BytesIO(DOWNLOAD_DATA), "game files.zip")},
+                           content_type="multipart/form-data")
+    check(response.status_code == 200, "a download is uploaded")
+    build = io.BytesIO()
+    with zipfile.ZipFile(build, "w") as build_zip:
+        build_zip.writestr("index.html", "<html></html>")
+        build_zip.writestr("Build/game.wasm.br", BUILD_DATA)
+    response = client.post(f"/project/{project_id}/upload/content",
+                           data={"type": "game", "file": (io.BytesIO(build.getvalue()), "game.zip", "application/zip")},
+                           content_type="multipart/form-data")
+    check(response.status_code in (200, 202), "a WebGL build is uploaded")
+    with app.app_context():
+        for attempt in range(100):
+            if ExtractionJobs.query.filter(ExtractionJobs.status.in_(["queued", "running"])).count() == 0:
+                break
+            time.sleep(0.1)
+            db.session.remove()
+        return project_id, db.session.get(Projects, project_id).content_version
+
+
+
+def check_modes(app, project_id, version):
+    """Checks the responses of the download and build file routes in each FILE_OFFLOAD mode."""
+    import storage as storage_module
+    from storage import storage
+
+    client = app.test_client()
+    build_route = f"/project/{project_id}/build/{version}"
+    #Sets the asset token cookie which build files are checked against.
+    client.get(f"{build_route}/index.html")
+    offload = storage_module.FILE_OFFLOAD
+    try:
+        storage_module.FILE_OFFLOAD = ""
+        print("FILE_OFFLOAD unset:")
+        response = client.post(f"/project/{project_id}/download", data={"filename": "game_files.zip"})
+        check(response.status_code == 200 and response.data == DOWNLOAD_DATA, "the download is sent by the worker")
+        check(response.headers["Content-Disposition"] == "attachment; filename=game_files.zip",
+              "the download is an attachment with its file name")
+        response = client.get(f"{build_route}/Build/game.wasm", headers={"Accept-Encoding": "br"})
+        etag = response.headers.get("ETag")
+        check(response.data == BUILD_DATA and response.content_encoding == "br"
+              and response.mimetype == "application/wasm", "the compressed build file is sent with its encoding")
+        response = client.get(f"{build_route}/Build/game.wasm", headers={"Accept-Encoding": "br", "Range": "bytes=10-19"})
+        check(response.status_code == 206 and response.data == BUILD_DATA[10:20], "a range is sent")
+        response = client.get(f"{build_route}/Build/game.wasm",
+                              headers={"Accept-Encoding": "br", "If-None-Match": etag})
+        check(response.status_code == 304, "a matching If-None-Match is answered with 304")
+
+        for mode, header in storage_module.FILE_OFFLOAD_HEADERS.items():
+            storage_module.FILE_OFFLOAD = mode
+            print(f"FILE_OFFLOAD={mode}:")
+            response = client.post(f"/project/{project_id}/download", data={"filename": "game_files.zip"})
+            location = response.headers.get(header)
+            check(response.status_code == 200 and response.data == b"" and location is not None,
+                  f"the download is handed over in {header}, with no body")
+            check(response.headers["Content-Disposition"] == "attachment; filename=game_files.zip"
+                  and response.mimetype == "application/zip", "the content type and file name are kept")
+            if mode == "x-accel-redirect":
+                check(location.startswith(storage_module.FILE_OFFLOAD_PREFIX), "the URI is under FILE_OFFLOAD_PREFIX")
+                path = storage.local_path(unquote(location[len(storage_module.FILE_OFFLOAD_PREFIX):]))
+            else:
+                check(os.path.isabs(location), "the path is absolute")
+                path = location
+            with open(path, "rb") as file:
+                check(file.read() == DOWNLOAD_DATA, "it names the stored download")
+            response = client.get(f"{build_route}/Build/game.wasm", headers={"Accept-Encoding": "br"})
+            check(response.data == b"" and response.headers.get(header, "").endswith("Build/game.wasm.br"),
+                  "the compressed build file is handed over in its place")
+            check(response.content_encoding == "br" and response.mimetype == "application/wasm"
+                  and "immutable" in response.headers["Cache-Control"],
+                  "its encoding, content type and cache headers are kept")
+            response = client.get(f"{build_route}/Build/missing.wasm")
+            check(response.status_code == 404 and header not in response.headers, "a missing file is not handed over")
+    finally:
+        storage_module.FILE_OFFLOAD = offload
+
+
+
+def nginx_config(folder, nginx_port, app_port, storage_root):
+    """Returns an nginx configuration serving nginx_offload.conf's site from folder."""
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "nginx_offload.conf")) as config_file:
+        site = config_file.read()
+    site = (site.replace("server 127.0.0.1:8000;", f"server 127.0.0.1:{app_port};")
+                .replace("listen 80;", f"listen 127.0.0.1:{nginx_port};")
+                .replace("alias /srv/showcase/;", f"alias {storage_root.rstrip('/')}/;"))
+    return f"""
+daemon off;
+pid {folder}/nginx.pid;
+error_log {folder}/error.log;
+events {{}}
+http {{
+    access_log off;
+    client_body_temp_path {folder}/client_body;
+    proxy_temp_path {folder}/proxy;
+    fastcgi_temp_path {folder}/fastcgi;
+    uwsgi_temp_path {folder}/uwsgi;
+    scgi_temp_path {folder}/scgi;
+    {site}
+}}
+"""
+
+
+
+def free_port():
+    """Returns a port which nothing is listening on."""
+    with socket.socket() as listener:
+        listener.bind(("127.0.0.1", 0))
+        return listener.getsockname()[1]
+
+
+
+def check_nginx(nginx, app, project_id, version, folder):
+    """Runs nginx with nginx_offload.conf in front of the app, and fetches files through it."""
+    import storage as storage_module
+    from storage import storage
+    from werkzeug.serving import make_server
+
+    storage_module.FILE_OFFLOAD = "x-accel-redirect"
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    nginx_folder = os.path.join(folder, "nginx")
+    os.makedirs(nginx_folder)
+    nginx_port = free_port()
+    config_path = os.path.join(nginx_folder, "nginx.conf")
+    with open(config_path, "w") as config_file:
+        config_file.write(nginx_config(nginx_folder, nginx_port, server.server_port, storage.root))
+    process = subprocess.Popen([nginx, "-p", nginx_folder, "-c", config_path])
+    try:
+        base_url = f"http://127.0.0.1:{nginx_port}"
+        opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+        for attempt in range(50):
+            try:
+                opener.open(f"{base_url}/project/{project_id}/build/{version}/index.html")
+                break
+            except OSError:
+                time.sleep(0.1)
+
+        def fetch(path, data=None, headers={}):
+            request = urllib.request.Request(base_url + path, data=data, headers=headers)
+            try:
+                with opener.open(request) as response:
+                    return response.status, response.headers, response.read()
+            except urllib.error.HTTPError as error:
+                return error.code, error.headers, error.read()
+
+        print(f"nginx {nginx} in front of the app, with FILE_OFFLOAD=x-accel-redirect:")
+        download = urlencode({"filename": "game_files.zip"}).encode()
+        status, headers, body = fetch(f"/project/{project_id}/download", download)
+        check(status == 200 and body == DOWNLOAD_DATA, "nginx sends the download")
+        check(headers["Content-Disposition"] == "attachment; filename=game_files.zip"
+              and headers["Content-Type"] == "application/zip", "with the app's content type and file name")
+        build_file = f"/project/{project_id}/build/{version}/Build/game.wasm"
+        status, headers, body = fetch(build_file, headers={"Accept-Encoding": "br"})
+        check(status == 200 and body == BUILD_DATA and headers["Content-Encoding"] == "br"
+              and headers["Content-Type"] == "application/wasm", "nginx sends the build file with its encoding")
+        check("immutable" in headers["Cache-Control"], "with the app's cache headers")
+        status, headers, body = fetch(build_file, headers={"Accept-Encoding": "br", "Range": "bytes=10-19"})
+        check(status == 206 and body == BUILD_DATA[10:20], "nginx answers a range request")
+        status, headers, body = fetch(build_file, headers={"Accept-Encoding": "br", "If-None-Match": headers["ETag"]})
+        check(status == 304, "nginx answers a matching If-None-Match with 304")
+        status, headers, body = fetch(build_file, headers={"Accept-Encoding": "br",
+                                                           "If-Modified-Since": "Sun, 01 Jan 2040 00:00:00 GMT"})
+        check(status == 304, "nginx answers If-Modified-Since a later time with 304")
+        status, headers, body = fetch("/protected/" + storage_module.storage_key("projects", project_id))
+        check(status == 404, "files cannot be requested from nginx directly")
+    finally:
+        process.terminate()
+        process.wait()
+        server.shutdown()
+
+
+
+def main():
+    nginx = sys.argv[1] if len(sys.argv) > 1 else shutil.which("nginx")
+    with tempfile.TemporaryDirectory() as folder:
+        #Read by constants.py, so set before the app is imported.
+        os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(folder, "offload.db")
+        os.environ["STORAGE_BACKEND"] = "local"
+        from web_app import app
+        from storage import storage
+        storage.root = os.path.join(folder, "storage")
+        project_id, version = make_project(app, folder)
+        check_modes(app, project_id, version)
+        if nginx is None:
+            print("nginx is not installed, so was not run.")
+        else:
+            check_nginx(nginx, app, project_id, version, folder)
+    print("All checks passed.")
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""
+Web app to provide feedback from and to students and teachers.
+Author: Joseph Grace
+Checks the S3 storage backend against a bucket: saving, opening, stat, listing, copying, touching,
+deleting and sending files, including conditional requests and handing files to nginx.
+Without an endpoint the bucket is mocked in process by the moto package.
+With one, eg. a MinIO server, the bucket must exist, and credentials are found by boto3 as usual.
+Every object written is under a new prefix, and is deleted afterwards.
+
+Usage: python check_s3_storage.py [endpoint_url bucket]
+"""
+
+import io
+import os
+import sys
+import time
+import uuid
+
+from flask import Flask
+
+#Own imports:
+import storage as storage_module
+from storage import S3Storage
+
+
+def check(condition, description):
+    """Prints whether a check passed, and raises AssertionError if it did not."""
+    print(f"{'ok  ' if condition else 'FAIL'} {description}")
+    if not condition:
+        raise AssertionError(description)
+
+
+
+def check_storage(storage):
+    """Runs every check against the storage, which should hold no files."""
+    app = Flask(__name__)
+    data = b"0123456789" * 100000
+
+    storage.save("projects/1/downloads/game.zip", io.BytesIO(data))
+    with storage.open("projects/1/downloads/game.zip") as file:
+        check(file.read() == data, "open reads back what save wrote")
+    size, modified = storage.stat("projects/1/downloads/game.zip")
+    check(size == len(data) and abs(modified - time.time()) < 300, "stat gives the size and modification time")
+    check(storage.stat("projects/1/missing") is None, "stat of a missing file is None")
+    try:
+        storage.open("projects/1/missing")
+        check(False, "open of a missing file raises FileNotFoundError")
+    except FileNotFoundError:
+        check(True, "open of a missing file raises FileNotFoundError")
+
+    local_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), f"check_s3_{uuid.uuid4().hex}.tmp")
+    with open(local_file, "wb") as file:
+        file.write(b"thumbnail")
+    storage.save_file("projects/1/thumbnail", local_file)
+    check(not os.path.exists(local_file) and storage.stat("projects/1/thumbnail")[0] == 9,
+          "save_file uploads the file and removes the local copy")
+    storage.copy("projects/1/thumbnail", "projects/2/thumbnail")
+    with storage.open("projects/2/thumbnail") as file:
+        check(file.read() == b"thumbnail", "copy copies within the bucket")
+    storage.save("projects/10/thumbnail", io.BytesIO(b"other project"))
+
+    keys = sorted(key for key, size, modified in storage.list("projects/1"))
+    check(keys == ["projects/1/downloads/game.zip", "projects/1/thumbnail"],
+          "list gives the keys under a folder, not under folders sharing its name as a prefix")
+    check(sum(1 for file in storage.list("projects")) == 4, "list includes files in subfolders")
+
+    time.sleep(1.1)
+    storage.touch("projects/2/thumbnail")
+    check(storage.stat("projects/2/thumbnail")[1] > storage.stat("projects/1/thumbnail")[1],
+          "touch updates the modification time")
+    storage.delete("projects/2/thumbnail")
+    storage.delete("projects/2/thumbnail")
+    check(storage.stat("projects/2/thumbnail") is None, "delete removes a file, and ignores a missing one")
+
+    with app.test_request_context():
+        response = storage.send("projects/1/downloads/game.zip", as_attachment=True, max_age=60)
+        body = b"".join(response.response)
+        response.close()
+        check(response.status_code == 200 and body == data, "send streams the whole file")
+        check(response.content_length == len(data) and response.mimetype == "application/zip",
+              "send sets the length and content type")
+        check("attachment" in response.headers.get("Content-Disposition", "")
+              and "game.zip" in response.headers["Content-Disposition"], "send sets the attachment file name")
+        check(response.cache_control.max_age == 60 and response.cache_control.public, "send sets the cache headers")
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        check(etag is not None and last_modified is not None, "send sets the ETag and Last-Modified headers")
+    with app.test_request_context(headers={"If-None-Match": etag}):
+        response = storage.send("projects/1/downloads/game.zip")
+        response.close()
+        check(response.status_code == 304, "send answers a matching If-None-Match with 304")
+    with app.test_request_context(headers={"If-Modified-Since": last_modified}):
+        response = storage.send("projects/1/downloads/game.zip")
+        response.close()
+        check(response.status_code == 304, "send answers If-Modified-Since the file's time with 304")
+    with app.test_request_context():
+        try:
+            storage.send("projects/1/missing")
+            check(False, "send of a missing file raises FileNotFoundError")
+        except FileNotFoundError:
+            check(True, "send of a missing file raises FileNotFoundError")
+
+    offload = storage_module.FILE_OFFLOAD
+    storage_module.FILE_OFFLOAD = "x-accel-redirect"
+    try:
+        with app.test_request_context():
+            response = storage.send("projects/1/downloads/game.zip", as_attachment=True)
+            check(response.headers.get("X-Accel-Redirect")
+                  == storage_module.FILE_OFFLOAD_PREFIX + storage.object_key("projects/1/downloads/game.zip")
+                  and response.get_data() == b"", "send with x-accel-redirect names the object for nginx")
+            try:
+                storage.send("projects/1/missing")
+                check(False, "send with x-accel-redirect of a missing file raises FileNotFoundError")
+            except FileNotFoundError:
+                check(True, "send with x-accel-redirect of a missing file raises FileNotFoundError")
+    finally:
+        storage_module.FILE_OFFLOAD = offload
+
+    for index in range(1005):
+        storage.save(f"projects/3/builds/1/file{index}", io.BytesIO(b"x"))
+    storage.delete_prefix("projects/3")
+    check(sum(1 for file in storage.list("projects/3")) == 0, "delete_prefix deletes over a thousand files")
+    check(storage.stat("projects/10/thumbnail") is not None,
+          "delete_prefix leaves folders sharing its name as a prefix")
+    check(storage.set_aside("projects/1") == "projects/1", "set_aside leaves objects to be deleted")
+    storage.delete_prefix("projects")
+    check(sum(1 for file in storage.list("projects")) == 0, "delete_prefix empties a folder")
+
+
+
+def main():
+    prefix = f"check_{uuid.uuid4().hex}/"
+    if len(sys.argv) > 2:
+        storage = S3Storage(sys.argv[2], prefix, sys.argv[1])
+        try:
+            check_storage(storage)
+        finally:
+            storage.delete_prefix("projects")
+    else:
+        from moto import mock_aws
+        os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+        os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+        os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+        with mock_aws():
+            storage = S3Storage("showcase", prefix)
+            storage.client.create_bucket(Bucket="showcase")
+            check_storage(storage)
+    print("All checks passed.")
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""
+Web app to provide feedback from and to students and teachers.
+Author: Joseph Grace
+Contains the publish/subscribe bus which carries live project events to Server-Sent Event streams.
+Each subscriber has a bounded queue, so a slow client cannot hold up publishers or grow without limit.
+The in-process bus may be replaced with set_event_bus, and a Redis broker is used
+when EVENT_BROKER_URL is set, so events reach subscribers in every worker process.
+"""
+
+import json
+
+from collections import defaultdict
+from queue import Queue, Empty, Full
+from threading import Lock
+
+try:
+    import redis
+except ImportError:
+    #Without redis only the in-process bus is available.
+    redis = None
+
+#Own imports:
+from constants import *
+
+
+#Event telling a subscriber it missed events, and must fetch the current state again.
+RESET_EVENT = ("reset", {})
+
+
+class Subscription:
+    """Bounded queue of (event type, data) events published to a subscriber."""
+
+    def __init__(self, queue_size=EVENT_QUEUE_SIZE):
+        self.queue = Queue(queue_size)
+
+
+    def put(self, event):
+        """
+        Queues the event without blocking.
+        If the queue is full the subscriber has fallen behind, so its queued events
+        are replaced by a single reset event.
+        """
+        try:
+            self.queue.put_nowait(event)
+        except Full:
+            with self.queue.mutex:
+                self.queue.queue.clear()
+            self.queue.put_nowait(RESET_EVENT)
+
+
+    def get(self, timeout):
+        """Returns the next event, or None if there is none within timeout seconds."""
+        try:
+            return self.queue.get(timeout=timeout)
+        except Empty:
+            return None
+
+
+
+class EventBus:
+    """
+    Thread-safe in-process bus which delivers events published on a channel
+    to every subscription to that channel in this process.
+    """
+
+    def __init__(self):
+        self.subscriptions = defaultdict(set)
+        self.lock = Lock()
+
+
+    def subscription_count(self):
+        """Returns the number of open subscriptions in this process."""
+        with self.lock:
+            return sum(len(subscriptions) for subscriptions in self.subscriptions.values())
+
+
+    def subscribe(self, channel):
+        """Returns a new subscription to the channel."""
+        subscription = Subscription()
+        with self.lock:
+            self.subscriptions[channel].add(subscription)
+        return subscription
+
+
+    def unsubscribe(self, channel, subscription):
+        """Ends the subscription to the channel."""
+        with self.lock:
+            self.subscriptions[channel].discard(subscription)
+            if not self.subscriptions[channel]:
+                del self.subscriptions[channel]
+
+
+    def publish(self, channel, event_type, data):
+        """Publishes an event with JSON serialisable data to the channel."""
+        self.deliver(channel, event_type, data)
+
+
+    def deliver(self, channel, event_type, data):
+        """Queues an event for every subscription to the channel in this process."""
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            subscription.put((event_type, data))
+
+
+
+class RedisEventBus(EventBus):
+    """
+    Bus which publishes events through a Redis broker,
+    and delivers every event on a project channel to this process's subscriptions.
+    """
+
+    def __init__(self, broker_url):
+        if redis is None:
+            raise RuntimeError("EVENT_BROKER_URL is set, but the redis package is not installed.")
+        super().__init__()
+        self.broker = redis.Redis.from_url(broker_url)
+        pubsub = self.broker.pubsub(ignore_subscribe_messages=True)
+        pubsub.psubscribe(**{project_channel("*"): self.receive})
+        self.listener = pubsub.run_in_thread(daemon=True)
+
+
+    def publish(self, channel, event_type, data):
+        """Publishes an event with JSON serialisable data to the channel in every process."""
+        self.broker.publish(channel, json.dumps([event_type, data]))
+
+
+    def receive(self, message):
+        """Delivers an event received from the broker."""
+        event_type, data = json.loads(message["data"])
+        self.deliver(message["channel"].decode(), event_type, data)
+
+
+
+def project_channel(project_id):
+    """Returns the name of the channel carrying a project's events."""
+    return f"project_{project_id}"
+
+
+
+event_bus = RedisEventBus(EVENT_BROKER_URL) if EVENT_BROKER_URL else EventBus()
+
+
+def get_event_bus():
+    """Returns the bus used for live events."""
+    return event_bus
+
+
+
+def set_event_bus(bus):
+    """Replaces the bus used for live events, eg. with one backed by another broker."""
+    global event_bus
+    event_bus = bus
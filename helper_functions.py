@@ -5,11 +5,20 @@ Contains helper functions.
 """
 
 import os
+import re
+import hmac
+import hashlib
 
+from collections import OrderedDict
+from threading import Lock
 from secrets import choice
 from datetime import datetime, timezone, timedelta
 
-import requests
+try:
+    from PIL import Image
+except ImportError:
+    #Without Pillow no thumbnail variants are generated, and the original thumbnail is served instead.
+    Image = None
 
 #Own imports:
 from access_names import *
@@ -17,6 +26,53 @@ from constants import *
     
 
 
+class LRUCache:
+    """
+    Thread-safe dictionary holding at most 'size' items,
+    discarding the least recently used item when full.
+    A size of 0 disables the cache.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = Lock()
+
+
+    def get(self, key, default=None):
+        """Returns the value for key and marks it as recently used, or default if it is not cached."""
+        with self.lock:
+            if key not in self.items:
+                return default
+            self.items.move_to_end(key)
+            return self.items[key]
+
+
+    def set(self, key, value):
+        """Caches the value for key, discarding the least recently used item if the cache is full."""
+        if self.size <= 0:
+            return
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+
+    def remove(self, key):
+        """Removes key from the cache if it is cached."""
+        with self.lock:
+            self.items.pop(key, None)
+
+
+    def remove_matching(self, predicate):
+        """Removes every key for which predicate(key) is true."""
+        with self.lock:
+            for key in [key for key in self.items if predicate(key)]:
+                del self.items[key]
+
+
+
 def get_current_time():
     """Returns the current time as an offset-aware datetime object in UTC"""
     return datetime.now(TIMEZONE)
@@ -66,6 +122,157 @@ def format_time_delta(time_delta):
 
 
 
+def make_cursor(time, item_id):
+    """
+    Returns a url-safe cursor string marking a position in a listing
+    ordered by time then id.
+    """
+    return f"{time.strftime(CURSOR_TIME_FORMAT)}-{item_id}"
+
+
+
+def read_cursor(cursor):
+    """
+    Returns a 2-tuple (time, id) from a cursor string made by make_cursor,
+    or None if the cursor is missing or invalid.
+    """
+    try:
+        time_string, item_id = cursor.split("-")
+        return (datetime.strptime(time_string, CURSOR_TIME_FORMAT), int(item_id))
+    except (AttributeError, ValueError):
+        return None
+
+
+
+def normalise_cursor(cursor):
+    """
+    Returns the cursor string as make_cursor writes it, or None if it is missing or invalid,
+    so that cursors naming the same position are equal.
+    """
+    position = read_cursor(cursor)
+    if position is None:
+        return None
+    return make_cursor(*position)
+
+
+
+def parse_page_size(page_size_string):
+    """
+    Returns the requested page size as an int between 1 and MAX_PROJECT_PAGE_SIZE,
+    or PROJECT_PAGE_SIZE if the string is missing or invalid.
+    """
+    try:
+        return min(MAX_PROJECT_PAGE_SIZE, max(1, int(page_size_string)))
+    except (TypeError, ValueError):
+        return PROJECT_PAGE_SIZE
+
+
+
+def search_match_string(search_text):
+    """
+    Returns an fts5 match string which matches every word of search_text as a prefix,
+    or None if search_text contains no words.
+    """
+    words = re.findall(r"\w+", search_text.lower())
+    if not words:
+        return None
+    return " ".join(f'"{word}"*' for word in words)
+
+
+
+def save_stream(stream, file_path, max_size, append=False):
+    """
+    Writes the stream to file_path in blocks of UPLOAD_BLOCK_SIZE bytes, appending if 'append' is true.
+    Returns True, or False if the stream held more than max_size bytes,
+    in which case the file is truncated back to the size it had before writing.
+    """
+    file = open(file_path, "ab" if append else "wb")
+    start_size = file.tell()
+    written = 0
+    while True:
+        block = stream.read(UPLOAD_BLOCK_SIZE)
+        if not block:
+            break
+        written += len(block)
+        if written > max_size:
+            file.truncate(start_size)
+            file.close()
+            return False
+        file.write(block)
+    file.close()
+    return True
+
+
+
+def file_hash(file_path):
+    """Returns the hex SHA-256 digest of the file's contents, read in blocks of UPLOAD_BLOCK_SIZE bytes."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(UPLOAD_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+
+def sign_asset_token(key, project_id, is_public, lifetime=ASSET_TOKEN_LIFETIME):
+    """
+    Returns a token signed with key, authorising requests for the project's build files
+    for 'lifetime' seconds. is_public records whether the files may be stored in shared caches.
+    """
+    expires = int(get_current_time().timestamp()) + lifetime
+    message = f"{project_id}:{expires}:{int(is_public)}"
+    signature = hmac.new(key, message.encode(), hashlib.sha256).hexdigest()
+    return f"{expires}:{int(is_public)}:{signature}"
+
+
+
+def read_asset_token(key, project_id, token):
+    """
+    Checks a token made by sign_asset_token for the project.
+    Returns whether the token is for public files, or None if the token is invalid or expired.
+    """
+    try:
+        expires, is_public, signature = token.split(":")
+        if int(expires) < get_current_time().timestamp():
+            return None
+    except (AttributeError, ValueError):
+        return None
+    message = f"{project_id}:{expires}:{is_public}"
+    expected_signature = hmac.new(key, message.encode(), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(signature, expected_signature):
+        return None
+    return is_public == "1"
+
+
+
+def make_thumbnail_variants(source, variant_folder):
+    """
+    Writes resized copies of the image in source, a path or binary file object, to variant_folder,
+    named '{size}.{extension}' for each size in THUMBNAIL_SIZES and format in THUMBNAIL_FORMATS.
+    Each file is written under a temporary name first, so a variant is never served half-written.
+    Returns whether the variants were made, which requires Pillow.
+    """
+    if Image is None:
+        return False
+    if not os.path.exists(variant_folder):
+        os.makedirs(variant_folder)
+    image = Image.open(source)
+    image = image.convert("RGBA")
+    #JPEG has no transparency: flatten onto white.
+    flat_image = Image.new("RGB", image.size, (255, 255, 255))
+    flat_image.paste(image, mask=image.getchannel("A"))
+    for size, width in THUMBNAIL_SIZES.items():
+        for extension, image_format in THUMBNAIL_FORMATS.items():
+            variant = (image if image_format == "WEBP" else flat_image).copy()
+            variant.thumbnail((width, width))
+            variant_path = os.path.join(variant_folder, f"{size}.{extension}")
+            variant.save(variant_path + ".part", image_format, quality=THUMBNAIL_QUALITY)
+            os.replace(variant_path + ".part", variant_path)
+    image.close()
+    return True
+
+
+
 def file_location(path):
     """Takes path from app directory and returns absolute path."""
     return os.path.join(APP_DIR, path)
@@ -92,8 +299,3 @@ def get_key(filename):
     key = file.read()
     file.close()
     return key
-
-
-
-def get_google_provider_cfg():
-    return requests.get(GOOGLE_DISCOVERY_URL).json()
\ No newline at end of file
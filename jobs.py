@@ -0,0 +1,355 @@
+"""
+Web app to provide feedback from and to students and teachers.
+Author: Joseph Grace
+Contains the background worker pools which extract uploaded WebGL content and resize thumbnails,
+and the sweeper which deletes expired and orphaned data.
+Extraction jobs are queued in the extraction_jobs table, so queued jobs survive a restart.
+Usage: python jobs.py sweep
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from io import BytesIO
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Thread, Event
+
+from sqlalchemy import not_, or_
+
+#Own imports:
+from access_names import *
+from constants import *
+from tables import *
+from storage import storage, storage_key
+
+
+extraction_pool = ThreadPoolExecutor(max_workers=EXTRACTION_WORKERS, thread_name_prefix="extraction")
+thumbnail_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="thumbnail")
+cleanup_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cleanup")
+
+#Extractions for the same project are run one at a time, so their build swaps cannot interleave.
+project_locks = defaultdict(Lock)
+
+
+def queue_extraction(project, zip_path):
+    """
+    Queues extraction of the zip file at zip_path into a new build of the project's webgl content.
+    Returns the ExtractionJobs object.
+    """
+    job = ExtractionJobs(project_id=project.project_id,
+                         zip_path=zip_path,
+                         status="queued",
+                         time_created=get_current_time())
+    db.session.add(job)
+    db.session.commit()
+    extraction_pool.submit(run_extraction_job, job.job_id)
+    return job
+
+
+
+def run_extraction_job(job_id):
+    """
+    Claims the queued job with the given id and extracts its zip file,
+    recording whether the extraction succeeded.
+    """
+    with app.app_context():
+        try:
+            #Claim the job, unless another worker already has.
+            claimed = ExtractionJobs.query.filter_by(job_id=job_id, status="queued").update(
+                {"status": "running", "time_started": get_current_time()})
+            db.session.commit()
+            if not claimed:
+                return
+            job = ExtractionJobs.query.get(job_id)
+            project = Projects.query.get(job.project_id)
+            try:
+                if project is None:
+                    raise FileNotFoundError("The project has been deleted.")
+                with project_locks[project.project_id]:
+                    old_version = project.extract_webgl_content(job.zip_path, f"webgl_staging_{job_id}")
+                    job.status = "done"
+                    job.time_finished = get_current_time()
+                    #Committed while locked, so the project's next extraction releases this content's blobs.
+                    db.session.commit()
+            except Exception as error:
+                db.session.rollback()
+                job.status = "failed"
+                job.message = str(error) or "Extraction failed."
+                job.time_finished = get_current_time()
+                db.session.commit()
+                if os.path.exists(job.zip_path):
+                    os.remove(job.zip_path)
+            else:
+                if old_version is not None:
+                    remove_later(project.key("builds", old_version))
+        finally:
+            db.session.remove()
+
+
+
+def resume_extraction_jobs():
+    """
+    Queues every job left queued when the app last stopped,
+    and fails jobs left running by a process which stopped during extraction.
+    """
+    fail_stale_extraction_jobs()
+    for job in ExtractionJobs.query.filter_by(status="queued"):
+        extraction_pool.submit(run_extraction_job, job.job_id)
+
+
+
+def fail_stale_extraction_jobs():
+    """
+    Fails jobs which have been running for longer than EXTRACTION_JOB_TIMEOUT, deleting their zip files.
+    Their process has stopped, so they would otherwise be polled, and keep their zip files, forever.
+    Jobs from before start times were recorded have none, and are always stale.
+    Returns the number of jobs failed.
+    """
+    cutoff = get_current_time() - timedelta(seconds=EXTRACTION_JOB_TIMEOUT)
+    stale = or_(ExtractionJobs.time_started < cutoff, ExtractionJobs.time_started == None)
+    failed = 0
+    for job_id, zip_path in db.session.query(ExtractionJobs.job_id, ExtractionJobs.zip_path).filter(
+            ExtractionJobs.status == "running", stale).all():
+        #Failed only if still running, in case the job finished meanwhile.
+        if ExtractionJobs.query.filter(ExtractionJobs.job_id == job_id, ExtractionJobs.status == "running").update(
+                {"status": "failed",
+                 "message": "The extraction was interrupted. Please upload the content again.",
+                 "time_finished": get_current_time()}, synchronize_session=False):
+            db.session.commit()
+            failed += 1
+            if os.path.exists(zip_path):
+                os.remove(zip_path)
+    db.session.commit()
+    return failed
+
+
+
+def queue_thumbnails(project):
+    """Queues generation of the variants of the project's current thumbnail."""
+    thumbnail_pool.submit(generate_thumbnails,
+                          project.key("thumbnail"),
+                          project.key("thumbnails"),
+                          project.thumbnail_version)
+
+
+
+def generate_thumbnails(thumbnail_key, variants_prefix, version):
+    """
+    Generates the variants of the stored thumbnail into a folder named by version under variants_prefix,
+    then deletes the variants of older versions.
+    The variants are made in a temporary folder in the uploads folder, then stored.
+    Until the variants exist, the original thumbnail is served in their place.
+    """
+    variant_folder = tempfile.mkdtemp(prefix="thumbnails_", dir=UPLOADS_FOLDER)
+    try:
+        thumbnail_file = storage.open(thumbnail_key)
+        thumbnail = BytesIO(thumbnail_file.read())
+        thumbnail_file.close()
+        if not make_thumbnail_variants(thumbnail, variant_folder):
+            return
+        for filename in os.listdir(variant_folder):
+            storage.save_file(storage_key(variants_prefix, version, filename), os.path.join(variant_folder, filename))
+    except (OSError, ValueError):
+        #Not an image Pillow can read: the original is served instead.
+        return
+    finally:
+        shutil.rmtree(variant_folder, ignore_errors=True)
+    old_versions = set(key.split("/")[-2] for key, size, modified in storage.list(variants_prefix))
+    for old_version in old_versions - {version}:
+        storage.delete_prefix(storage_key(variants_prefix, old_version))
+
+
+
+def remove_later(prefix):
+    """
+    Deletes the stored files under prefix in the background.
+    Local files are first moved aside under a name starting with DELETED_FOLDER_PREFIX, so they are gone at once.
+    Files left behind by a restart are deleted by the next sweep.
+    """
+    deleted_prefix = storage.set_aside(prefix)
+    if deleted_prefix is not None:
+        cleanup_pool.submit(storage.delete_prefix, deleted_prefix)
+
+
+
+#Sweeper
+
+def delete_in_batches(model, key_column, condition, blob_column=None):
+    """
+    Deletes the rows of model matching condition, SWEEP_BATCH_SIZE at a time,
+    committing after each batch. Returns the number of rows deleted.
+    If blob_column is given, the blobs the deleted rows refer to are released.
+    """
+    columns = [key_column] if blob_column is None else [key_column, blob_column]
+    deleted = 0
+    while True:
+        rows = db.session.query(*columns).filter(condition).limit(SWEEP_BATCH_SIZE).all()
+        if not rows:
+            return deleted
+        if blob_column is not None:
+            release_blobs([row[1] for row in rows if row[1] is not None])
+        deleted += model.query.filter(key_column.in_([row[0] for row in rows])).delete(synchronize_session=False)
+        db.session.commit()
+
+
+
+def is_older_than(path, seconds):
+    """Returns whether the file or folder at path was last modified more than seconds ago."""
+    try:
+        return time.time() - os.path.getmtime(path) > seconds
+    except OSError:
+        return False
+
+
+
+def is_stored_older_than(key, seconds):
+    """Returns whether the stored file with the given key was last modified more than seconds ago."""
+    file_stat = storage.stat(key)
+    return file_stat is not None and time.time() - file_stat[1] > seconds
+
+
+
+def sweep():
+    """
+    Fails interrupted extraction jobs, and deletes expired and used up share links, rows and folders
+    left behind by deleted projects, abandoned uploads, old finished extraction jobs, and blobs no longer referred to.
+    Returns a dictionary of what was deleted to the number deleted.
+    """
+    current_time = get_current_time()
+    upload_cutoff = current_time - timedelta(seconds=UPLOAD_EXPIRY)
+    job_cutoff = current_time - timedelta(seconds=EXTRACTION_JOB_RETENTION)
+    project_ids = db.session.query(Projects.project_id)
+    reclaimed = {}
+
+    reclaimed["interrupted extraction jobs"] = fail_stale_extraction_jobs()
+
+    reclaimed["expired share links"] = delete_in_batches(ShareLinks, ShareLinks.url_string,
+                                                         not_(share_link_is_live(current_time)))
+
+    #Abandoned uploads have their part files deleted along with their rows.
+    abandoned_uploads = or_(Uploads.time_created < upload_cutoff, not_(Uploads.project_id.in_(project_ids)))
+    reclaimed["abandoned uploads"] = 0
+    while True:
+        uploads = Uploads.query.filter(abandoned_uploads).limit(SWEEP_BATCH_SIZE).all()
+        if not uploads:
+            break
+        for upload in uploads:
+            if os.path.exists(upload.part_path()):
+                os.remove(upload.part_path())
+            db.session.delete(upload)
+        db.session.commit()
+        reclaimed["abandoned uploads"] += len(uploads)
+
+    reclaimed["finished extraction jobs"] = delete_in_batches(ExtractionJobs, ExtractionJobs.job_id,
+                                                              and_(ExtractionJobs.status.in_(["done", "failed"]),
+                                                                   ExtractionJobs.time_finished < job_cutoff))
+
+    for model, key_column, blob_column in [(ProjectPermissions, ProjectPermissions.access_id, None),
+                                           (Comments, Comments.comment_id, None),
+                                           (ShareLinks, ShareLinks.url_string, None),
+                                           (Downloads, Downloads.download_id, Downloads.blob_hash),
+                                           (ContentFiles, ContentFiles.content_file_id, ContentFiles.blob_hash),
+                                           (ExtractionJobs, ExtractionJobs.job_id, None)]:
+        reclaimed[f"orphaned {model.__tablename__}"] = delete_in_batches(model, key_column,
+                                                                         not_(model.project_id.in_(project_ids)),
+                                                                         blob_column)
+    if has_search_index():
+        reclaimed["orphaned search entries"] = db.session.execute(
+            text("DELETE FROM projects_fts WHERE rowid NOT IN (SELECT project_id FROM projects)")).rowcount
+        db.session.commit()
+
+    #Staged files which no upload or queued extraction refers to, and staging folders left by a restart.
+    in_use = set(upload.part_path() for upload in Uploads.query)
+    in_use.update(job.zip_path for job in ExtractionJobs.query.filter(ExtractionJobs.status.in_(["queued", "running"])))
+    reclaimed["staged files"] = 0
+    for filename in (os.listdir(UPLOADS_FOLDER) if os.path.exists(UPLOADS_FOLDER) else []):
+        file_path = os.path.join(UPLOADS_FOLDER, filename)
+        if file_path not in in_use and is_older_than(file_path, UPLOAD_EXPIRY):
+            if os.path.isdir(file_path):
+                shutil.rmtree(file_path, ignore_errors=True)
+            else:
+                os.remove(file_path)
+            reclaimed["staged files"] += 1
+
+    #Files of deleted projects. Files without a project are given time,
+    #as an extraction may still be storing the files of a project being deleted.
+    live_projects = set(str(project_id) for project_id, in project_ids)
+    last_modified = {}
+    for key, size, modified in storage.list("projects"):
+        project_name = key.split("/")[1]
+        last_modified[project_name] = max(modified, last_modified.get(project_name, 0))
+    reclaimed["project folders"] = 0
+    for project_name, modified in last_modified.items():
+        if project_name.startswith(DELETED_FOLDER_PREFIX) or (project_name not in live_projects
+                                                              and time.time() - modified > UPLOAD_EXPIRY):
+            storage.delete_prefix(storage_key("projects", project_name))
+            reclaimed["project folders"] += 1
+
+    #Blobs without references. Storing a blob touches its file, so blobs are given time
+    #in case an upload is reusing one, and each row is only deleted if it still has no references.
+    unreferenced = [blob_hash for blob_hash, in db.session.query(Blobs.blob_hash).filter(Blobs.ref_count <= 0)]
+    reclaimed["unreferenced blobs"] = 0
+    for batch_start in range(0, len(unreferenced), SWEEP_BATCH_SIZE):
+        deleted_blobs = []
+        for blob_hash in unreferenced[batch_start:batch_start + SWEEP_BATCH_SIZE]:
+            blob_stat = storage.stat(blob_key(blob_hash))
+            if blob_stat is not None and time.time() - blob_stat[1] <= UPLOAD_EXPIRY:
+                continue
+            if Blobs.query.filter(Blobs.blob_hash == blob_hash,
+                                  Blobs.ref_count <= 0).delete(synchronize_session=False):
+                deleted_blobs.append(blob_hash)
+        db.session.commit()
+        for blob_hash in deleted_blobs:
+            if is_stored_older_than(blob_key(blob_hash), UPLOAD_EXPIRY):
+                storage.delete(blob_key(blob_hash))
+        reclaimed["unreferenced blobs"] += len(deleted_blobs)
+
+    #Blob files without a row, left by uploads which failed before committing.
+    stored_blobs = set(blob_hash for blob_hash, in db.session.query(Blobs.blob_hash))
+    reclaimed["stray blob files"] = 0
+    for key, size, modified in storage.list("blobs"):
+        if key.split("/")[-1] not in stored_blobs and time.time() - modified > UPLOAD_EXPIRY:
+            storage.delete(key)
+            reclaimed["stray blob files"] += 1
+    return reclaimed
+
+
+
+sweeper_stop = Event()
+
+
+def start_sweeper(interval=SWEEP_INTERVAL):
+    """
+    Runs sweep every interval seconds on a background thread, logging what was reclaimed.
+    An interval of 0 disables the sweeper.
+    """
+    if interval <= 0:
+        return
+
+    def run():
+        while not sweeper_stop.wait(interval):
+            with app.app_context():
+                try:
+                    reclaimed = sweep()
+                    app.logger.info("Sweep reclaimed: %s", reclaimed)
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception("Sweep failed.")
+                finally:
+                    db.session.remove()
+
+    Thread(target=run, name="sweeper", daemon=True).start()
+
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["sweep"]:
+        for description, count in sweep().items():
+            print(f"Deleted {count} {description}.")
+    else:
+        exit("Usage: python jobs.py sweep")
@@ -0,0 +1,142 @@
+"""
+Web app to provide feedback from and to students and teachers.
+Author: Joseph Grace
+Contains the OpenID Connect provider used for Google login,
+and the bounded I/O pool on which login requests to the provider are made.
+The provider may be replaced with set_login_provider, eg. by a StaticProvider in tests.
+"""
+
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, BoundedSemaphore
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+#Own imports:
+from constants import *
+
+
+class GoogleProvider:
+    """
+    Makes requests to Google's OpenID Connect endpoints over a pooled HTTP session,
+    with timeouts and retries.
+    The discovery document is cached for as long as its Cache-Control header allows.
+    """
+
+    def __init__(self, discovery_url=GOOGLE_DISCOVERY_URL):
+        self.discovery_url = discovery_url
+        self.config = None
+        self.config_expires = 0
+        self.lock = Lock()
+
+        #Only idempotent requests are retried after a response or read error,
+        #as an authorization code may only be exchanged once.
+        retry = Retry(total=LOGIN_RETRIES,
+                      backoff_factor=0.2,
+                      status_forcelist=[500, 502, 503, 504],
+                      allowed_methods=["GET"])
+        adapter = HTTPAdapter(pool_maxsize=LOGIN_POOL_SIZE, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+
+    def get_config(self):
+        """Returns the provider's discovery document, fetching it if the cached copy has expired."""
+        with self.lock:
+            if self.config is None or time.monotonic() >= self.config_expires:
+                response = self.session.get(self.discovery_url, timeout=LOGIN_TIMEOUT)
+                response.raise_for_status()
+                self.config = response.json()
+                self.config_expires = time.monotonic() + cache_max_age(response.headers.get("Cache-Control", ""))
+            return self.config
+
+
+    def exchange_code(self, token_url, headers, body, auth):
+        """Posts the prepared token request, and returns the token response as a dictionary."""
+        response = self.session.post(token_url, headers=headers, data=body, auth=auth, timeout=LOGIN_TIMEOUT)
+        return response.json()
+
+
+    def get_userinfo(self, uri, headers, body):
+        """Requests the user's profile from the userinfo endpoint, and returns it as a dictionary."""
+        response = self.session.get(uri, headers=headers, data=body, timeout=LOGIN_TIMEOUT)
+        return response.json()
+
+
+
+class StaticProvider:
+    """Stand-in provider which returns fixed responses without making any requests."""
+
+    def __init__(self, config, token_response, userinfo):
+        self.config = config
+        self.token_response = token_response
+        self.userinfo = userinfo
+
+    def get_config(self): return self.config
+    def exchange_code(self, token_url, headers, body, auth): return self.token_response
+    def get_userinfo(self, uri, headers, body): return self.userinfo
+
+
+
+def cache_max_age(cache_control):
+    """
+    Returns the number of seconds a response may be cached for, from its Cache-Control header,
+    or DISCOVERY_DEFAULT_MAX_AGE if the header gives no max-age.
+    """
+    if "no-store" in cache_control or "no-cache" in cache_control:
+        return 0
+    match = re.search(r"max-age=(\d+)", cache_control)
+    if match is None:
+        return DISCOVERY_DEFAULT_MAX_AGE
+    return int(match.group(1))
+
+
+
+class LoginBusy(Exception):
+    """Raised when too many logins are already waiting on the provider."""
+
+
+
+login_provider = GoogleProvider()
+
+#Login exchanges with the provider run on their own pool. Each holds a request thread while it runs,
+#so at most LOGIN_MAX_PENDING, fewer than WORKER_THREADS, may run at once.
+login_pool = ThreadPoolExecutor(max_workers=LOGIN_WORKERS, thread_name_prefix="login")
+login_slots = BoundedSemaphore(LOGIN_MAX_PENDING)
+
+
+def get_login_provider():
+    """Returns the provider used for login."""
+    return login_provider
+
+
+
+def set_login_provider(provider):
+    """Replaces the provider used for login."""
+    global login_provider
+    login_provider = provider
+
+
+
+def get_google_provider_cfg():
+    """Returns the login provider's discovery document."""
+    return login_provider.get_config()
+
+
+
+def run_login_exchange(exchange, *args):
+    """
+    Runs exchange(*args) on the login pool, and returns its result.
+    Raises LoginBusy if no slot frees up within LOGIN_QUEUE_TIMEOUT seconds,
+    so that a burst of logins is turned away before it takes every request thread.
+    """
+    if not login_slots.acquire(timeout=LOGIN_QUEUE_TIMEOUT):
+        raise LoginBusy()
+    try:
+        return login_pool.submit(exchange, *args).result()
+    finally:
+        login_slots.release()
@@ -0,0 +1,316 @@
+"""
+Web app to provide feedback from and to students and teachers.
+Author: Joseph Grace
+Contains versioned database schema migrations, and a report of the query plans of hot queries.
+Usage: python migrations.py [migrate|explain]
+"""
+
+import os
+import sys
+import time
+
+from contextlib import contextmanager
+from sqlalchemy import inspect
+from sqlalchemy.orm import load_only
+
+try:
+    import fcntl
+except ImportError:
+    #Without fcntl (eg. on Windows) processes cannot wait for each other's migrations,
+    #so run 'python migrations.py migrate' alone before starting the web app's workers.
+    fcntl = None
+
+#Own imports:
+from access_names import *
+from constants import *
+from tables import *
+from storage import storage
+
+
+#Key of the PostgreSQL advisory lock held while migrating.
+MIGRATION_ADVISORY_LOCK = 7234001
+
+
+class SchemaMigrations(db.Model):
+    __tablename__ = "schema_migrations"
+
+    #Columns
+    version = Column(Integer, primary_key=True)
+    description = Column(Text)
+    time_applied = Column(DateTime)
+
+
+def create_index(model, index_name):
+    """Creates the index with the given name declared on the model's table, if it does not exist."""
+    for index in model.__table__.indexes:
+        if index.name == index_name:
+            index.create(db.engine, checkfirst=True)
+            return
+    raise KeyError(index_name)
+
+
+
+def add_column(model, column_name):
+    """Adds the column declared on the model to its existing table, if it is missing."""
+    table_name = model.__tablename__
+    existing_columns = [column["name"] for column in inspect(db.engine).get_columns(table_name)]
+    if column_name in existing_columns:
+        return
+    column_type = model.__table__.columns[column_name].type.compile(db.engine.dialect)
+    db.session.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}"))
+
+
+
+def legacy_folder(project):
+    """Returns the local folder in which the project's files were kept before they were stored by key."""
+    return os.path.join(PROJECTS_FOLDER, str(project.project_id))
+
+
+
+#Migrations
+
+def create_tables():
+    """Creates any missing tables, along with their declared indexes."""
+    db.create_all()
+
+
+
+def add_dashboard_indexes():
+    create_index(Projects, "ix_projects_owner_updated")
+    create_index(ProjectPermissions, "ix_project_permissions_user_access")
+
+
+
+def add_hot_query_indexes():
+    create_index(Projects, "ix_projects_public_updated")
+    create_index(ProjectPermissions, "ix_project_permissions_project_user")
+    create_index(ShareLinks, "ix_share_links_project")
+    #No longer declared on Comments, as add_comment_time_index replaces it.
+    db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_comments_project ON comments (project_id)"))
+
+
+def import_download_logs():
+    """
+    Creates the downloads table, and fills it from the 'downloads.txt' log of each project.
+    Where a log lists a filename more than once, the latest entry is kept.
+    """
+    Downloads.__table__.create(db.engine, checkfirst=True)
+    for project in Projects.query.options(load_only(Projects.project_id)):
+        log_name = os.path.join(legacy_folder(project), "downloads.txt")
+        if not os.path.exists(log_name):
+            continue
+        download_log = open(log_name, "r")
+        log_text = download_log.readlines()
+        download_log.close()
+        latest_entries = {}
+        for entry in log_text:
+            try:
+                filename, username, time = entry.strip().split(",")
+                time = string_to_time(time)
+            except ValueError:
+                continue
+            if filename not in latest_entries or time > latest_entries[filename][1]:
+                latest_entries[filename] = (username, time)
+        for filename, (username, time) in latest_entries.items():
+            existing_download = db.session.query(Downloads.download_id).filter_by(project_id=project.project_id,
+                                                                                  filename=filename).first()
+            if existing_download is None:
+                db.session.add(Downloads(project_id=project.project_id,
+                                         filename=filename,
+                                         username=username,
+                                         time_uploaded=time))
+
+
+
+def add_thumbnail_version():
+    add_column(Projects, "thumbnail_version")
+    #Existing thumbnails are served in place of variants until they are uploaded again.
+    for project in Projects.query.options(load_only(Projects.project_id)):
+        if os.path.exists(os.path.join(legacy_folder(project), "thumbnail")):
+            project.thumbnail_version = "original"
+
+
+
+def import_descriptions():
+    """
+    Moves the 'description.txt' file of each project into the projects table,
+    and adds the descriptions to the search index.
+    """
+    add_column(Projects, "description")
+    for project in Projects.query.options(load_only(Projects.project_id, Projects.name, Projects.tags,
+                                                    Projects.authors, Projects.description)):
+        description_file = os.path.join(legacy_folder(project), "description.txt")
+        if os.path.exists(description_file):
+            with open(description_file, "r") as file:
+                project.description = file.read()
+        project.update_search_index()
+
+
+
+def add_comment_time_index():
+    create_index(Comments, "ix_comments_project_time")
+    db.session.execute(text("DROP INDEX IF EXISTS ix_comments_project"))
+
+
+
+def move_files_to_blobs():
+    """
+    Creates the blob tables, and moves each project's downloads and WebGL content into the blob store.
+    WebGL content stays in place as links to its blobs.
+    """
+    create_tables()
+    add_column(Downloads, "blob_hash")
+    for download in Downloads.query.filter(Downloads.blob_hash == None):
+        file_path = os.path.join(PROJECTS_FOLDER, str(download.project_id), "downloads", download.filename)
+        if os.path.exists(file_path):
+            download.blob_hash = store_blob(file_path)
+    for project in Projects.query.options(load_only(Projects.project_id)):
+        webgl_folder = os.path.join(legacy_folder(project), "webgl")
+        if os.path.exists(webgl_folder):
+            project.set_content_files(link_folder_to_blobs(webgl_folder, project.key("webgl")))
+
+
+
+def add_content_versions():
+    """Moves each project's webgl content into a build named by a new content version."""
+    add_column(Projects, "content_version")
+    for project in Projects.query.options(load_only(Projects.project_id, Projects.content_version)):
+        webgl_files = list(storage.list(project.key("webgl")))
+        if not webgl_files:
+            continue
+        project.content_version = format(time.time_ns(), "x")
+        for key, size, modified in webgl_files:
+            path = key[len(project.key("webgl")) + 1:]
+            storage.copy(key, project.key("builds", project.content_version, path))
+        storage.delete_prefix(project.key("webgl"))
+
+
+
+def add_job_start_time():
+    add_column(ExtractionJobs, "time_started")
+
+
+
+#Ordered list of (version, description, function). Append only: never edit an applied migration.
+MIGRATIONS = [
+    (1, "Create tables", create_tables),
+    (2, "Add dashboard indexes", add_dashboard_indexes),
+    (3, "Add full-text search index", create_search_index),
+    (4, "Add hot query indexes", add_hot_query_indexes),
+    (5, "Move download logs to downloads table", import_download_logs),
+    (6, "Add uploads table", create_tables),
+    (7, "Add extraction jobs table", create_tables),
+    (8, "Add project thumbnail versions", add_thumbnail_version),
+    (9, "Move project descriptions to projects table", import_descriptions),
+    (10, "Index comments by project and time", add_comment_time_index),
+    (11, "Move downloads and content to blob store", move_files_to_blobs),
+    (12, "Move content to versioned builds", add_content_versions),
+    (13, "Add extraction job start times", add_job_start_time),
+]
+
+
+
+def schema_version():
+    """Returns the version of the latest migration applied to the database, or 0 if none have been."""
+    SchemaMigrations.__table__.create(db.engine, checkfirst=True)
+    return db.session.query(db.func.max(SchemaMigrations.version)).scalar() or 0
+
+
+
+@contextmanager
+def migration_lock():
+    """
+    Holds an exclusive lock on MIGRATION_LOCK_FILE, so that of the worker processes starting at once,
+    one migrates while the others wait, then find the database up to date.
+    A PostgreSQL database, which may be shared by several servers, is also locked with an advisory lock.
+    """
+    with open(MIGRATION_LOCK_FILE, "a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            if db.engine.dialect.name == "postgresql":
+                with db.engine.connect() as connection:
+                    connection.execute(text("SELECT pg_advisory_lock(:key)"), {"key": MIGRATION_ADVISORY_LOCK})
+                    try:
+                        yield
+                    finally:
+                        connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATION_ADVISORY_LOCK})
+            else:
+                yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+
+def migrate():
+    """
+    Applies all migrations newer than the database's schema version, in order,
+    while holding the migration lock. Returns a list of the descriptions of applied migrations.
+    """
+    with migration_lock():
+        current_version = schema_version()
+        applied = []
+        for version, description, migration in MIGRATIONS:
+            if version <= current_version:
+                continue
+            migration()
+            db.session.add(SchemaMigrations(version=version,
+                                            description=description,
+                                            time_applied=get_current_time()))
+            db.session.commit()
+            applied.append(description)
+        return applied
+
+
+
+#Query plans
+
+def hot_queries():
+    """
+    Returns a list of 2-tuples (description, query) of the queries run on most page views,
+    with example parameters.
+    """
+    example_project_id = 1
+    example_user_id = "example_user"
+    return [
+        ("Index page listing", paginate_query(public_projects_query())),
+        ("Dashboard owned projects", paginate_query(owned_projects_query(example_user_id))),
+        ("Dashboard shared projects", paginate_query(shared_projects_query(example_user_id))),
+        ("Project access level", ProjectPermissions.query.filter_by(project_id=example_project_id,
+                                                                    user_id=example_user_id)),
+        ("Project share links", ShareLinks.query.filter(ShareLinks.project_id==example_project_id,
+                                                        ShareLinks.access_level_granted<=OWNER)),
+        ("Project comments", comments_page_query(example_project_id)),
+        ("Project downloads", Downloads.query.filter_by(project_id=example_project_id)
+                                             .order_by(Downloads.time_uploaded.desc())),
+        ("Unique download filename", Downloads.query.filter_by(project_id=example_project_id,
+                                                               filename="example.zip")),
+        ("Search", search_query("example", True)),
+    ]
+
+
+
+def explain():
+    """Prints the query plan of every hot query."""
+    explain_prefix = "EXPLAIN QUERY PLAN " if db.engine.dialect.name == "sqlite" else "EXPLAIN "
+    for description, query in hot_queries():
+        statement = query.statement.compile(db.engine, compile_kwargs={"literal_binds": True})
+        print(f"{description}:")
+        print(f"    {statement}".replace("\n", " "))
+        for row in db.session.execute(text(explain_prefix + str(statement))):
+            print("   ", " | ".join(str(column) for column in row))
+        print()
+
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "migrate"
+    if command == "migrate":
+        applied = migrate()
+        print("\n".join(applied) if applied else "Database is up to date.")
+    elif command == "explain":
+        migrate()
+        explain()
+    else:
+        exit(__doc__)
@@ -0,0 +1,86 @@
+"""
+Web app to provide feedback from and to students and teachers.
+Author: Joseph Grace
+A local stand-in for Google's OpenID Connect endpoints, for trying out and load testing login.
+Every login is accepted as a verified user with an email at the first allowed domain.
+
+Usage: python mock_oidc.py [port] [latency_seconds]
+Then start the web app with
+    GOOGLE_DISCOVERY_URL=http://localhost:<port>/.well-known/openid-configuration OAUTHLIB_INSECURE_TRANSPORT=1
+as the mock provider is served over plain HTTP.
+"""
+
+import sys
+import json
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, urlencode
+
+#Own imports:
+from constants import ALLOWED_EMAIL_DOMAINS
+
+
+class MockOIDCHandler(BaseHTTPRequestHandler):
+    """
+    Serves the discovery document, authorization, token and userinfo endpoints.
+    The token and userinfo endpoints wait for the server's latency, to act like a slow provider.
+    """
+
+    def send_json(self, data):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "public, max-age=3600")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        args = parse_qs(url.query)
+        base = "http://{}".format(self.headers["Host"])
+        if url.path == "/.well-known/openid-configuration":
+            self.send_json({"issuer": base,
+                            "authorization_endpoint": base + "/auth",
+                            "token_endpoint": base + "/token",
+                            "userinfo_endpoint": base + "/userinfo"})
+        elif url.path == "/auth":
+            #Log in straight away, with the code naming the user.
+            code = str(time.time_ns())
+            query = urlencode({"code": code, "state": args.get("state", [""])[0]})
+            self.send_response(302)
+            self.send_header("Location", args["redirect_uri"][0] + "?" + query)
+            self.end_headers()
+        elif url.path == "/userinfo":
+            time.sleep(self.server.latency)
+            token = self.headers.get("Authorization", "").split(" ")[-1]
+            self.send_json({"sub": token,
+                            "email": "user{}@{}".format(token, ALLOWED_EMAIL_DOMAINS[0]),
+                            "email_verified": True,
+                            "picture": "",
+                            "name": "Mock User {}".format(token)})
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        time.sleep(self.server.latency)
+        if urlparse(self.path).path != "/token":
+            self.send_error(404)
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        form = parse_qs(self.rfile.read(length).decode())
+        self.send_json({"access_token": form.get("code", [""])[0],
+                        "token_type": "Bearer",
+                        "expires_in": 3600})
+
+    def log_message(self, format, *args):
+        pass
+
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8001
+    server = ThreadingHTTPServer(("localhost", port), MockOIDCHandler)
+    server.latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.2
+    print("Mock OpenID Connect provider on http://localhost:{}".format(port))
+    server.serve_forever()
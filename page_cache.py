@@ -0,0 +1,193 @@
+"""
+Web app to provide feedback from and to students and teachers.
+Author: Joseph Grace
+Contains the cache of rendered pages served to anonymous and view-only visitors.
+Pages are cached in groups, eg. all pages of one project, so a whole group can be invalidated at once.
+"""
+
+import os
+import time
+import hashlib
+import tempfile
+
+from collections import OrderedDict
+from threading import Lock
+
+#Own imports:
+from constants import *
+
+
+class MemoryPageCache:
+    """
+    Thread-safe cache of rendered pages held in memory,
+    discarding the least recently used pages once they total more than max_bytes.
+    Pages older than max_age seconds are not served.
+    Only the process holding the cache sees its invalidations, so it suits a single worker process.
+    """
+
+    def __init__(self, max_bytes, max_age):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.pages = OrderedDict()
+        self.total_bytes = 0
+        self.lock = Lock()
+
+
+    def get(self, group, key):
+        """Returns the page cached under group and key, or None if there is no fresh page."""
+        with self.lock:
+            entry = self.pages.get((group, key))
+            if entry is None:
+                return None
+            time_cached, page = entry
+            if time.monotonic() - time_cached > self.max_age:
+                self.discard((group, key))
+                return None
+            self.pages.move_to_end((group, key))
+            return page
+
+
+    def set(self, group, key, page):
+        """Caches the page under group and key, discarding least recently used pages to make room."""
+        size = len(page)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            self.discard((group, key))
+            self.pages[(group, key)] = (time.monotonic(), page)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                self.discard(next(iter(self.pages)))
+
+
+    def invalidate(self, group):
+        """Removes every page cached in group."""
+        with self.lock:
+            for cache_key in [cache_key for cache_key in self.pages if cache_key[0] == group]:
+                self.discard(cache_key)
+
+
+    def discard(self, cache_key):
+        """Removes a page. The lock must be held."""
+        entry = self.pages.pop(cache_key, None)
+        if entry is not None:
+            self.total_bytes -= len(entry[1])
+
+
+
+class DiskPageCache:
+    """
+    Cache of rendered pages held as files in folder, shared by every worker process.
+    Pages older than max_age seconds are not served.
+    Once each process has written an eighth of max_bytes since it last looked, the folder is trimmed
+    to max_bytes, discarding expired pages and then the oldest, so the folder stays near max_bytes.
+    """
+
+    def __init__(self, folder, max_bytes, max_age):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.bytes_written = 0
+        self.lock = Lock()
+        os.makedirs(folder, exist_ok=True)
+
+
+    def page_path(self, group, key):
+        """Returns the path of the file for group and key. Files of a group share its name as a prefix."""
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.folder, f"{group}.{digest}.html")
+
+
+    def get(self, group, key):
+        """Returns the page cached under group and key, or None if there is no fresh page."""
+        page_path = self.page_path(group, key)
+        try:
+            if time.time() - os.path.getmtime(page_path) > self.max_age:
+                return None
+            with open(page_path, "r", encoding="utf-8") as page_file:
+                return page_file.read()
+        except OSError:
+            return None
+
+
+    def set(self, group, key, page):
+        """Caches the page under group and key. The file is replaced whole, so readers never see part of a page."""
+        page_path = self.page_path(group, key)
+        #Each writer has its own temporary file, as threads and processes may cache the same page at once.
+        temp_descriptor, temp_path = tempfile.mkstemp(dir=self.folder, suffix=".tmp")
+        try:
+            with os.fdopen(temp_descriptor, "w", encoding="utf-8") as page_file:
+                page_file.write(page)
+            os.replace(temp_path, page_path)
+        except OSError:
+            try:
+                os.remove(temp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        with self.lock:
+            self.bytes_written += len(page)
+            if self.bytes_written < self.max_bytes // 8:
+                return
+            self.bytes_written = 0
+        self.trim()
+
+
+    def trim(self):
+        """
+        Removes expired pages and temporary files left by stopped writers,
+        then the oldest pages until the rest total at most max_bytes.
+        """
+        current_time = time.time()
+        pages = []
+        for filename in os.listdir(self.folder):
+            path = os.path.join(self.folder, filename)
+            try:
+                stat_result = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if current_time - stat_result.st_mtime > self.max_age:
+                self.remove(path)
+            elif filename.endswith(".html"):
+                pages.append((stat_result.st_mtime, stat_result.st_size, path))
+        total_bytes = sum(size for modified, size, path in pages)
+        pages.sort()
+        for modified, size, path in pages:
+            if total_bytes <= self.max_bytes:
+                break
+            self.remove(path)
+            total_bytes -= size
+
+
+    def invalidate(self, group):
+        """Removes every page cached in group."""
+        prefix = f"{group}."
+        for filename in os.listdir(self.folder):
+            if filename.startswith(prefix) and filename.endswith(".html"):
+                self.remove(os.path.join(self.folder, filename))
+
+
+    def remove(self, path):
+        """Removes a file, if another process has not already."""
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+
+if PAGE_CACHE_FOLDER:
+    page_cache = DiskPageCache(PAGE_CACHE_FOLDER, PAGE_CACHE_MAX_BYTES, PAGE_CACHE_MAX_AGE)
+else:
+    page_cache = MemoryPageCache(PAGE_CACHE_MAX_BYTES, PAGE_CACHE_MAX_AGE)
+
+
+def project_page_group(project_id):
+    """Returns the cache group holding the pages of a project."""
+    return f"project_{project_id}"
+
+
+def invalidate_project_pages(project_id):
+    """Removes the cached pages of a project, and the cached listings which may show it."""
+    page_cache.invalidate(project_page_group(project_id))
+    page_cache.invalidate("index")
@@ -0,0 +1,81 @@
+//Infinite scrolling for project listings.
+//A listing is a '.project_links' element with 'data-listing' and 'data-cursor' attributes,
+//containing a '.listing_end' element which new projects are inserted before.
+
+function projectLink(project, listing){
+    var link = document.createElement("div");
+    link.className = "project_link";
+
+    var thumbnailDiv = document.createElement("div");
+    var thumbnailLink = document.createElement("a");
+    thumbnailLink.href = project.route;
+    var picture = document.createElement("picture");
+    var webpSource = document.createElement("source");
+    webpSource.type = "image/webp";
+    webpSource.srcset = project.thumbnail_srcsets.webp;
+    var thumbnail = document.createElement("img");
+    thumbnail.className = "thumbnail";
+    thumbnail.src = project.thumbnail_route;
+    thumbnail.srcset = project.thumbnail_srcsets.jpg;
+    picture.appendChild(webpSource);
+    picture.appendChild(thumbnail);
+    thumbnailLink.appendChild(picture);
+    thumbnailDiv.appendChild(thumbnailLink);
+
+    var detailsDiv = document.createElement("div");
+    var titleLink = document.createElement("a");
+    titleLink.href = project.route;
+    var title = document.createElement("h3");
+    title.textContent = project.name;
+    titleLink.appendChild(title);
+    var description = document.createElement("span");
+    description.textContent = project.description;
+    detailsDiv.appendChild(titleLink);
+    detailsDiv.appendChild(description);
+
+    link.appendChild(thumbnailDiv);
+    link.appendChild(detailsDiv);
+    if(listing == "owned"){
+        var deleteButton = document.createElement("button");
+        deleteButton.className = "delete";
+        deleteButton.textContent = "Delete Project";
+        deleteButton.onclick = function(){deleteProject(project.project_id, project.name);};
+        link.appendChild(deleteButton);
+    }
+    return link;
+}
+
+function loadMoreProjects(container, observer){
+    var cursor = container.dataset.cursor;
+    if(!cursor || container.dataset.loading){
+        return;
+    }
+    container.dataset.loading = "true";
+    var listing = container.dataset.listing;
+    var end = container.querySelector(".listing_end");
+    fetch("/projects/"+listing+"?cursor="+encodeURIComponent(cursor)).then(function(response){
+        return response.json();
+    }).then(function(page){
+        page.projects.forEach(function(project){
+            container.insertBefore(projectLink(project, listing), end);
+        });
+        container.dataset.cursor = page.next_cursor || "";
+        delete container.dataset.loading;
+        if(!page.next_cursor){
+            observer.unobserve(end);
+        }
+    }).catch(function(){
+        delete container.dataset.loading;
+    });
+}
+
+window.addEventListener("load", function(){
+    document.querySelectorAll(".project_links[data-listing]").forEach(function(container){
+        var observer = new IntersectionObserver(function(entries){
+            if(entries[0].isIntersecting){
+                loadMoreProjects(container, observer);
+            }
+        });
+        observer.observe(container.querySelector(".listing_end"));
+    });
+});
@@ -1,4 +1,6 @@
 var OFFLINE_ERROR = "Could not complete request. Please try again later.";
+//Milliseconds between checks for new comments, when they are not streamed.
+var COMMENT_POLL_INTERVAL = 30000;
 
 var MAX_THUMBNAIL_SIZE_MB = 0.4
 var MAX_DOWNLOAD_SIZE_MB = 10
@@ -112,7 +114,11 @@ function ajaxAddComment(route){
     $.post(route+"/comment", {text: newComment}, function(data, status){
         var newDescription = document.getElementById("description_input").value;
         //alert(newDescription);
-        $("#comments").prepend(data);
+        //The comment may already have arrived as a live event.
+        var comment = $($.parseHTML(data.trim()));
+        $("#"+comment.attr("id")).remove();
+        $("#comments").prepend(comment);
+        $("#no_comments").remove();
         $("#new_comment").val("");
     }).fail(function(xhr){
         if(xhr.readyState==4){
@@ -124,6 +130,96 @@ function ajaxAddComment(route){
 }
 
 
+function reloadComments(route){
+    $.getJSON(route+"/comments", function(data, status){
+        $("#comments").html(data.html);
+        if(data.html.trim() != ""){
+            $("#no_comments").remove();
+        }
+        var button = $("#more_comments");
+        if(data.next_cursor === null){
+            button.remove();
+        }else{
+            button.attr("data-cursor", data.next_cursor);
+        }
+    });
+}
+
+
+function pollComments(route){
+    //Shows new comments from other users every COMMENT_POLL_INTERVAL, keeping any older pages shown.
+    setInterval(function(){
+        $.getJSON(route+"/comments", function(data, status){
+            $($(data.html).filter(".comment").get().reverse()).each(function(){
+                if(document.getElementById(this.id) === null){
+                    $("#comments").prepend(this);
+                    $("#no_comments").remove();
+                }
+            });
+        });
+    }, COMMENT_POLL_INTERVAL);
+}
+
+
+function listenForComments(route, isLoggedIn){
+    //Shows comments from other users as they are posted, instead of on reload.
+    //Only logged in users are sent a stream, and others poll.
+    if(!isLoggedIn || !window.EventSource){
+        pollComments(route);
+        return;
+    }
+    var events = new EventSource(route+"/events");
+    var disconnected = false;
+    events.addEventListener("comment", function(event){
+        var data = JSON.parse(event.data);
+        if(document.getElementById("comment_"+data.comment_id) === null){
+            $("#comments").prepend(data.html);
+            $("#no_comments").remove();
+        }
+    });
+    events.addEventListener("delete_comment", function(event){
+        var data = JSON.parse(event.data);
+        $("#comment_"+data.comment_id).remove();
+    });
+    events.addEventListener("reset", function(event){
+        reloadComments(route);
+    });
+    //Events may have been missed while disconnected.
+    //The browser stops reconnecting if refused, eg. when the server has too many streams, so poll instead.
+    events.addEventListener("error", function(event){
+        disconnected = true;
+        if(events.readyState === EventSource.CLOSED){
+            pollComments(route);
+        }
+    });
+    events.addEventListener("open", function(event){
+        if(disconnected){
+            disconnected = false;
+            reloadComments(route);
+        }
+    });
+}
+
+
+function ajaxMoreComments(route){
+    var button = $("#more_comments");
+    $.getJSON(route+"/comments", {cursor: button.attr("data-cursor")}, function(data, status){
+        $("#comments").append(data.html);
+        if(data.next_cursor === null){
+            button.remove();
+        }else{
+            button.attr("data-cursor", data.next_cursor);
+        }
+    }).fail(function(xhr){
+        if(xhr.readyState==4){
+            alert(xhr.responseText);
+        }else{
+            alert(OFFLINE_ERROR)
+        }
+    });
+}
+
+
 function ajaxRemoveComment(route, comment_id){
     if(confirm("Permanantly delete comment?")){
         $.post(route+"/deleteComment", {comment_id: comment_id}, function(data, status){
@@ -165,6 +261,40 @@ function ajaxAddAccess(route, form_id){
     });
 }
 
+function ajaxBulkAccess(form_id){
+    var form = document.getElementById(form_id);
+    $.ajax({
+        url: $(form).attr("action"),
+        type: "POST",
+        data: new FormData(form),
+        contentType: false,
+        processData: false,
+        success: function(data, status){
+            var errors = [];
+            data.results.forEach(function(result){
+                if(result.error === undefined){
+                    $("#access_"+String(result.access_id)).remove();
+                    $("#user_access_rows").prepend(result.html);
+                }else{
+                    errors.push("Row "+result.row+" ("+result.email+"): "+result.error);
+                }
+            });
+            form.reset();
+            if(errors.length > 0){
+                alert("Shared with "+data.assigned+" users. Not shared:\n"+errors.join("\n"));
+            }
+        },
+        error: function(xhr){
+            if(xhr.readyState==4){
+                alert(xhr.responseText);
+            }else{
+                alert(OFFLINE_ERROR)
+            }
+        }
+    });
+}
+
+
 function ajaxRemoveAccess(route, access_id){
     if(confirm("Unshare?")){
         $.post(route+"/deleteAccess", {access_id: access_id}, function(data, status){
@@ -266,59 +396,128 @@ function ajaxChangeThumbnail(route){
     });
 };
 
-function ajaxUploadDownload(route){
-    $.ajax({
-        url: $("#upload_download_form").attr("action"),
-        //contentType: "multipart/form-data",
-        type: "POST",
-        data: new FormData(document.getElementById("upload_download_form")),
-        contentType: false,
-        processData: false,
-        success: function(data, status, xhr){
-            //alert(data);
-            $("#downloads").prepend(data);
-        },
-        error: function(xhr){
-            if(xhr.readyState==4){
-                if(xhr.status==413){
-                    alert("File size is too large (Max "+MAX_DOWNLOAD_SIZE_MB+"MB)");
+var UPLOAD_CHUNK_SIZE = 1000 * 1000;
+var UPLOAD_RETRY_DELAY = 3000;
+var EXTRACTION_POLL_DELAY = 1000;
+
+function uploadFailed(xhr, maxSizeMB){
+    if(xhr.readyState==4){
+        if(xhr.status==413){
+            alert("File size is too large (Max "+maxSizeMB+"MB)");
+        }else{
+            alert(xhr.responseText);
+        }
+    }else{
+        alert(OFFLINE_ERROR)
+    }
+}
+
+function chunkedUpload(route, type, file, filename, maxSizeMB, success){
+    //Uploads file in chunks, resuming an earlier upload of the same file if there is one.
+    var storageKey = "upload:"+route+":"+type+":"+file.name+":"+file.size+":"+file.lastModified;
+
+    function sendChunk(uploadId, offset){
+        $.ajax({
+            url: route+"/upload/chunk?upload_id="+uploadId+"&offset="+offset,
+            type: "POST",
+            data: file.slice(offset, offset+UPLOAD_CHUNK_SIZE),
+            contentType: "application/octet-stream",
+            processData: false,
+            success: function(data, status, xhr){
+                if(xhr.status==202){
+                    sendChunk(uploadId, data.received);
                 }else{
-                    alert(xhr.responseText);
+                    localStorage.removeItem(storageKey);
+                    success(data);
+                }
+            },
+            error: function(xhr){
+                if(xhr.status==409){
+                    sendChunk(uploadId, xhr.responseJSON.received);
+                }else if(xhr.readyState!=4){
+                    //Connection lost: resume from what the server received.
+                    setTimeout(function(){resume(uploadId);}, UPLOAD_RETRY_DELAY);
+                }else{
+                    localStorage.removeItem(storageKey);
+                    uploadFailed(xhr, maxSizeMB);
                 }
+            }
+        });
+    }
+
+    function resume(uploadId){
+        $.get(route+"/upload/chunk?upload_id="+uploadId, function(data){
+            sendChunk(uploadId, data.received);
+        }).fail(function(xhr){
+            if(xhr.readyState==4){
+                start();
             }else{
-                alert(OFFLINE_ERROR)
+                setTimeout(function(){resume(uploadId);}, UPLOAD_RETRY_DELAY);
             }
-        }
+        });
+    }
+
+    function start(){
+        localStorage.removeItem(storageKey);
+        $.post(route+"/upload/start", {type: type, filename: filename, size: file.size}, function(uploadId){
+            localStorage.setItem(storageKey, uploadId);
+            sendChunk(uploadId, 0);
+        }).fail(function(xhr){
+            uploadFailed(xhr, maxSizeMB);
+        });
+    }
+
+    var existingUploadId = localStorage.getItem(storageKey);
+    if(existingUploadId){
+        resume(existingUploadId);
+    }else{
+        start();
+    }
+}
+
+function ajaxUploadDownload(route){
+    var form = document.getElementById("upload_download_form");
+    var file = form.elements["file"].files[0];
+    if(!file){
+        return;
+    }
+    var filename = form.elements["filename"].value || file.name;
+    chunkedUpload(route, "download", file, filename, MAX_DOWNLOAD_SIZE_MB, function(data){
+        $("#downloads").prepend(data);
     });
 };
 
 function ajaxUploadContent(route){
-    $.ajax({
-        url: $("#upload_content_form").attr("action"),
-        //contentType: "multipart/form-data",
-        type: "POST",
-        data: new FormData(document.getElementById("upload_content_form")),
-        contentType: false,
-        processData: false,
-        success: function(data, status, xhr){
-            //alert(data);
+    var form = document.getElementById("upload_content_form");
+    var file = form.elements["file"].files[0];
+    if(!file){
+        return;
+    }
+    chunkedUpload(route, form.elements["type"].value, file, file.name, MAX_CONTENT_SIZE_MB, function(data){
+        pollExtraction(data.status_route);
+    });
+};
+
+function pollExtraction(statusRoute){
+    //Waits for uploaded content to be extracted, then displays it.
+    $.get(statusRoute, function(data){
+        if(data.status=="done"){
             $("#content").empty();
-            $("#content").append(data);
+            $("#content").append(data.player);
             resizeContent();
-        },
-        error: function(xhr){
-            if(xhr.readyState==4){
-                if(xhr.status==413){
-                    alert("File size is too large (Max 20"+MAX_CONTENT_SIZE_MB+"MB)");
-                }else{
-                    alert(xhr.responseText);
-                }
-            }else{
-                alert(OFFLINE_ERROR)
-            }
+        }else if(data.status=="failed"){
+            alert("Upload failed: "+data.message);
+        }else{
+            setTimeout(function(){pollExtraction(statusRoute);}, EXTRACTION_POLL_DELAY);
+        }
+    }).fail(function(xhr){
+        if(xhr.readyState==4){
+            alert(xhr.responseText);
+        }else{
+            setTimeout(function(){pollExtraction(statusRoute);}, EXTRACTION_POLL_DELAY);
         }
     });
-};
+}
 
 function ajaxRemoveDownload(route, filename){
     if(confirm("Permanantly delete download?")){
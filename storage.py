@@ -0,0 +1,346 @@
+"""
+Web app to provide feedback from and to students and teachers.
+Author: Joseph Grace
+Contains the storage of project files and blobs.
+Files are named by keys, '/' separated paths such as 'projects/1/thumbnail'.
+They are kept on the local filesystem under APP_DIR, unless STORAGE_BACKEND is 's3',
+in which case they are kept in an S3 compatible bucket shared by every node.
+Files are read and written in blocks, so large files are never held in memory.
+When FILE_OFFLOAD is set, responses only name the file, and the front proxy sends it,
+so a worker is not held for the whole transfer. See nginx_offload.conf.
+"""
+
+import os
+import stat
+import time
+import shutil
+import mimetypes
+
+from urllib.parse import quote
+from flask import request, send_file, Response
+from werkzeug.security import safe_join
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:
+    #Without boto3 only local storage is available.
+    boto3 = None
+
+#Own imports:
+from constants import *
+
+
+def storage_key(*parts):
+    """Returns the key made by joining parts with '/'."""
+    return "/".join(str(part) for part in parts)
+
+
+
+def set_cache_headers(response, max_age):
+    """Sets the cache headers of a response sending a file, as send_file does."""
+    response.cache_control.no_cache = True
+    if max_age is not None:
+        if max_age > 0:
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+        response.cache_control.max_age = max_age
+        response.expires = int(time.time() + max_age)
+
+
+
+def offload_response(header, location, filename, mimetype=None, as_attachment=False, max_age=None):
+    """
+    Returns an empty response which hands the file at location to the front proxy in the given header.
+    The proxy sends the file along with the content type, disposition and cache headers set here,
+    and answers conditional and range requests itself.
+    """
+    if mimetype is None:
+        mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    response = Response(mimetype=mimetype)
+    response.headers[header] = location
+    if as_attachment:
+        response.headers.set("Content-Disposition", "attachment", filename=filename)
+    set_cache_headers(response, max_age)
+    return response
+
+
+
+class LocalStorage:
+    """Storage of files in folders under root, named by their keys."""
+
+    def __init__(self, root):
+        self.root = root
+
+
+    def local_path(self, key):
+        """Returns the path of the file with the given key. Keys leading outside of root are not found."""
+        path = safe_join(self.root, key)
+        if path is None:
+            raise FileNotFoundError(key)
+        return path
+
+
+    def open(self, key):
+        """Returns a binary file object reading the file with the given key."""
+        return open(self.local_path(key), "rb")
+
+
+    def save(self, key, stream):
+        """
+        Writes the stream to the file with the given key, in blocks of UPLOAD_BLOCK_SIZE bytes.
+        The file is replaced whole, so readers never see part of a file.
+        """
+        path = self.local_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{time.time_ns():x}.part"
+        with open(temp_path, "wb") as file:
+            shutil.copyfileobj(stream, file, UPLOAD_BLOCK_SIZE)
+        os.replace(temp_path, path)
+
+
+    def save_file(self, key, file_path):
+        """Moves the local file at file_path to the file with the given key."""
+        path = self.local_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(file_path, path)
+
+
+    def copy(self, source_key, key):
+        """Copies a file to the given key, as a hard link where the filesystem allows."""
+        source_path = self.local_path(source_key)
+        path = self.local_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            os.link(source_path, path)
+        except OSError:
+            shutil.copyfile(source_path, path)
+
+
+    def stat(self, key):
+        """Returns a 2-tuple (size in bytes, modification time in seconds since the epoch), or None if there is no file."""
+        try:
+            stat_result = os.stat(self.local_path(key))
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        if not stat.S_ISREG(stat_result.st_mode):
+            return None
+        return stat_result.st_size, stat_result.st_mtime
+
+
+    def touch(self, key):
+        """Sets the modification time of the file to now."""
+        os.utime(self.local_path(key))
+
+
+    def delete(self, key):
+        """Deletes the file with the given key, if it exists."""
+        try:
+            os.remove(self.local_path(key))
+        except FileNotFoundError:
+            pass
+
+
+    def list(self, prefix):
+        """Yields 3-tuples (key, size, modification time) of every file whose key is under the folder prefix."""
+        folder = self.local_path(prefix)
+        for directory, subdirectories, filenames in os.walk(folder):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                try:
+                    stat_result = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                key = os.path.relpath(path, self.root).replace(os.sep, "/")
+                yield key, stat_result.st_size, stat_result.st_mtime
+
+
+    def set_aside(self, prefix):
+        """
+        Moves the files under the folder prefix aside, under a name starting with DELETED_FOLDER_PREFIX,
+        so they are gone at once. Returns the prefix they were moved to, or None if there were none.
+        """
+        folder = self.local_path(prefix)
+        if not os.path.exists(folder):
+            return None
+        parent, name = os.path.split(folder)
+        deleted_folder = os.path.join(parent, f"{DELETED_FOLDER_PREFIX}{name}_{time.time_ns():x}")
+        os.rename(folder, deleted_folder)
+        return os.path.relpath(deleted_folder, self.root).replace(os.sep, "/")
+
+
+    def delete_prefix(self, prefix):
+        """Deletes every file under the folder prefix."""
+        shutil.rmtree(self.local_path(prefix), ignore_errors=True)
+
+
+    def send(self, key, mimetype=None, as_attachment=False, download_name=None, max_age=None):
+        """
+        Returns a response sending the file with the given key, which answers conditional and range requests.
+        If FILE_OFFLOAD is set the front proxy is handed the file, by URI under FILE_OFFLOAD_PREFIX
+        for 'x-accel-redirect', or by path for 'x-sendfile'.
+        Raises FileNotFoundError if there is no file.
+        """
+        path = self.local_path(key)
+        if FILE_OFFLOAD:
+            if not os.path.isfile(path):
+                raise FileNotFoundError(key)
+            if FILE_OFFLOAD == "x-sendfile":
+                location = path
+            else:
+                location = FILE_OFFLOAD_PREFIX + quote(key)
+            return offload_response(FILE_OFFLOAD_HEADERS[FILE_OFFLOAD], location, download_name or os.path.basename(path),
+                                    mimetype, as_attachment, max_age)
+        return send_file(path, mimetype=mimetype, as_attachment=as_attachment,
+                         download_name=download_name, max_age=max_age)
+
+
+
+def is_missing(error):
+    """Returns whether a boto3 ClientError reports that there is no such object."""
+    return error.response["Error"]["Code"] in ("NoSuchKey", "404")
+
+
+
+class S3Storage:
+    """
+    Storage of files as objects in an S3 compatible bucket, named by prefix followed by their keys.
+    endpoint_url selects a service other than Amazon S3, eg. a MinIO server.
+    Credentials are found by boto3, eg. from the AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY variables.
+    """
+
+    def __init__(self, bucket, prefix="", endpoint_url=None):
+        if boto3 is None:
+            raise RuntimeError("STORAGE_BACKEND is 's3', but the boto3 package is not installed.")
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = boto3.client("s3", endpoint_url=endpoint_url)
+
+
+    def object_key(self, key):
+        return self.prefix + key
+
+
+    def local_path(self, key):
+        """Objects have no local path."""
+        return None
+
+
+    def open(self, key):
+        """Returns a binary file object reading the file with the given key."""
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self.object_key(key))["Body"]
+        except ClientError as error:
+            if is_missing(error):
+                raise FileNotFoundError(key) from error
+            raise
+
+
+    def save(self, key, stream):
+        """Writes the stream to the file with the given key, uploading large streams in parts."""
+        self.client.upload_fileobj(stream, self.bucket, self.object_key(key))
+
+
+    def save_file(self, key, file_path):
+        """Moves the local file at file_path to the file with the given key."""
+        self.client.upload_file(file_path, self.bucket, self.object_key(key))
+        os.remove(file_path)
+
+
+    def copy(self, source_key, key):
+        """Copies a file to the given key, within the bucket."""
+        self.client.copy({"Bucket": self.bucket, "Key": self.object_key(source_key)},
+                         self.bucket, self.object_key(key))
+
+
+    def stat(self, key):
+        """Returns a 2-tuple (size in bytes, modification time in seconds since the epoch), or None if there is no file."""
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=self.object_key(key))
+        except ClientError as error:
+            if is_missing(error):
+                return None
+            raise
+        return head["ContentLength"], head["LastModified"].timestamp()
+
+
+    def touch(self, key):
+        """Sets the modification time of the file to now, by copying the object onto itself."""
+        object_key = self.object_key(key)
+        try:
+            self.client.copy_object(Bucket=self.bucket, Key=object_key,
+                                    CopySource={"Bucket": self.bucket, "Key": object_key},
+                                    MetadataDirective="REPLACE")
+        except ClientError as error:
+            if is_missing(error):
+                raise FileNotFoundError(key) from error
+            raise
+
+
+    def delete(self, key):
+        """Deletes the file with the given key, if it exists."""
+        self.client.delete_object(Bucket=self.bucket, Key=self.object_key(key))
+
+
+    def list(self, prefix):
+        """Yields 3-tuples (key, size, modification time) of every file whose key is under the folder prefix."""
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.object_key(prefix.rstrip("/") + "/")):
+            for item in page.get("Contents", []):
+                yield item["Key"][len(self.prefix):], item["Size"], item["LastModified"].timestamp()
+
+
+    def set_aside(self, prefix):
+        """Objects cannot be moved at once, so they are left under prefix to be deleted."""
+        return prefix
+
+
+    def delete_prefix(self, prefix):
+        """Deletes every file under the folder prefix, a thousand objects per request."""
+        keys = [key for key, size, modified in self.list(prefix)]
+        for batch_start in range(0, len(keys), 1000):
+            objects = [{"Key": self.object_key(key)} for key in keys[batch_start:batch_start + 1000]]
+            self.client.delete_objects(Bucket=self.bucket, Delete={"Objects": objects, "Quiet": True})
+
+
+    def send(self, key, mimetype=None, as_attachment=False, download_name=None, max_age=None):
+        """
+        Returns a response streaming the file with the given key from the bucket, which answers conditional requests.
+        If FILE_OFFLOAD is 'x-accel-redirect', nginx is handed the object by URI under FILE_OFFLOAD_PREFIX instead,
+        to fetch from the bucket itself. Objects have no path to hand over for 'x-sendfile', so are streamed.
+        Raises FileNotFoundError if there is no file.
+        """
+        filename = download_name or key.split("/")[-1]
+        if FILE_OFFLOAD == "x-accel-redirect":
+            if self.stat(key) is None:
+                raise FileNotFoundError(key)
+            return offload_response("X-Accel-Redirect", FILE_OFFLOAD_PREFIX + quote(self.object_key(key)), filename,
+                                    mimetype, as_attachment, max_age)
+        try:
+            s3_object = self.client.get_object(Bucket=self.bucket, Key=self.object_key(key))
+        except ClientError as error:
+            if is_missing(error):
+                raise FileNotFoundError(key) from error
+            raise
+        if mimetype is None:
+            mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        body = s3_object["Body"]
+        response = Response(body.iter_chunks(UPLOAD_BLOCK_SIZE), mimetype=mimetype, direct_passthrough=True)
+        response.call_on_close(body.close)
+        response.content_length = s3_object["ContentLength"]
+        response.last_modified = s3_object["LastModified"]
+        response.set_etag(s3_object["ETag"].strip('"'))
+        if as_attachment:
+            response.headers.set("Content-Disposition", "attachment", filename=filename)
+        set_cache_headers(response, max_age)
+        return response.make_conditional(request)
+
+
+
+if FILE_OFFLOAD and FILE_OFFLOAD not in FILE_OFFLOAD_HEADERS:
+    raise RuntimeError(f"FILE_OFFLOAD must be one of {', '.join(FILE_OFFLOAD_HEADERS)}, not '{FILE_OFFLOAD}'.")
+
+if STORAGE_BACKEND == "s3":
+    storage = S3Storage(STORAGE_BUCKET, STORAGE_PREFIX, STORAGE_ENDPOINT_URL)
+else:
+    storage = LocalStorage(APP_DIR)
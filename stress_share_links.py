@@ -0,0 +1,129 @@
+"""
+Web app to provide feedback from and to students and teachers.
+Author: Joseph Grace
+A concurrency stress test of share link redemption, through the app's invite route.
+Users in several processes, each with many threads, redeem one CAN_EDIT link to a private project at once.
+The test fails unless exactly as many users as the link's limit are let in, and its use count equals the limit.
+A fresh database is made in a temporary folder, so the app's own database is untouched.
+
+Usage: python stress_share_links.py [users] [user_limit] [processes] [rounds]
+"""
+
+import os
+import sys
+import time
+import tempfile
+import threading
+import multiprocessing
+
+
+def redeem_all(app, project_id, url_string, user_ids, barrier, results):
+    """Redeems the link once for each user, each in its own thread, all starting together."""
+    codes = []
+
+    def redeem(user_id):
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session["_user_id"] = user_id
+            session["_fresh"] = True
+        barrier.wait()
+        codes.append(client.get(f"/project/{project_id}/invite/{url_string}").status_code)
+
+    threads = [threading.Thread(target=redeem, args=(user_id,)) for user_id in user_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put(codes)
+
+
+
+def run_process(project_id, url_string, user_ids, barrier, results):
+    """Redeems the link for the users in a worker process, with connections of its own."""
+    from web_app import app, db
+
+    with app.app_context():
+        db.engine.dispose()
+    redeem_all(app, project_id, url_string, user_ids, barrier, results)
+
+
+
+def run_round(round_number, users, user_limit, processes):
+    """Runs one burst of redemptions of a new link, returning a list of failures found."""
+    from web_app import app, db, Users, ProjectPermissions, ShareLinks, create_project, get_current_time
+    from access_names import NO_ACCESS, CAN_EDIT
+
+    user_ids = [f"stress_{round_number}_{user_index}" for user_index in range(users)]
+    url_string = f"stress{round_number}"
+    with app.app_context():
+        owner_id = f"stress_owner_{round_number}"
+        for user_id in [owner_id] + user_ids:
+            db.session.add(Users(user_id=user_id, name=user_id, email=f"{user_id}@example.com", profile_pic_url=""))
+        project = create_project("Stress test", owner_id, default_access=NO_ACCESS,
+                                 student_access=NO_ACCESS, class_access=NO_ACCESS)
+        db.session.flush()
+        project_id = project.project_id
+        db.session.add(ShareLinks(url_string=url_string, project_id=project_id, access_level_granted=CAN_EDIT,
+                                  time_created=get_current_time(), user_limit=user_limit))
+        db.session.commit()
+        db.session.remove()
+        db.engine.dispose()
+
+    context = multiprocessing.get_context("fork")
+    barrier = context.Barrier(users)
+    results = context.Queue()
+    workers = [context.Process(target=run_process,
+                               args=(project_id, url_string, user_ids[process_index::processes], barrier, results))
+               for process_index in range(processes)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    codes = []
+    for worker in workers:
+        codes += results.get()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+
+    admitted = codes.count(302)
+    refused = codes.count(404)
+    with app.app_context():
+        times_used = db.session.get(ShareLinks, url_string).times_used
+        granted = ProjectPermissions.query.filter(ProjectPermissions.project_id==project_id,
+                                                  ProjectPermissions.user_id.in_(user_ids),
+                                                  ProjectPermissions.access_level==CAN_EDIT).count()
+    print(f"Round {round_number}: {users} redemptions in {elapsed:.2f}s, "
+          f"{admitted} admitted, {refused} refused, times_used {times_used}, {granted} granted CAN_EDIT")
+
+    failures = []
+    if len(codes) != users or admitted + refused != users:
+        failures.append(f"unexpected responses {sorted(set(codes))}")
+    if admitted != user_limit:
+        failures.append(f"{admitted} users admitted, not {user_limit}")
+    if times_used != user_limit:
+        failures.append(f"times_used is {times_used}, not {user_limit}")
+    if granted != user_limit:
+        failures.append(f"{granted} users granted access, not {user_limit}")
+    return failures
+
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    user_limit = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+    processes = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+    rounds = int(sys.argv[4]) if len(sys.argv) > 4 else 5
+    failures = []
+    with tempfile.TemporaryDirectory() as folder:
+        #Read by constants.py, so set before the app is imported.
+        os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(folder, "stress.db")
+        for round_number in range(1, rounds + 1):
+            failures += run_round(round_number, users, user_limit, processes)
+    if failures:
+        exit("Failed: " + "; ".join(failures))
+    print(f"Passed: every link admitted exactly {user_limit} users.")
+
+
+
+if __name__ == "__main__":
+    main()
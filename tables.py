@@ -4,28 +4,92 @@ Author: Joseph Grace
 Contains flask_sqlalchemy database and flask app initialisation.
 """
 
-from flask import Flask, request, url_for, redirect, render_template, render_template_string, flash, session, abort, send_from_directory, send_file
+from flask import Flask, request, url_for, redirect, render_template, render_template_string, flash, session, abort, send_from_directory, send_file, g, has_app_context
 from flask_login import UserMixin, LoginManager, login_required, login_user, logout_user, current_user
 from flask_admin import Admin
 from flask_admin.contrib.sqla import ModelView
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey, or_
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey, Index, or_, and_, text, table, column, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import relationship, joinedload, Session
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
 
 from werkzeug.utils import secure_filename
 
+import time
+import shutil
+import sqlite3
+from zipfile import ZipFile
+from collections import Counter
+
 from datetime import datetime, timezone, timedelta
 
 #Own imports:
 from access_names import *
 from constants import *
 from helper_functions import *
+from page_cache import invalidate_project_pages
+from storage import storage, storage_key
+
+
+database_file = DATABASE_URL #Get path to database file
+
+
+def engine_options(database_url):
+    """Returns the SQLAlchemy engine options for the database."""
+    if database_url.startswith("sqlite"):
+        #Waiting for locks is set by set_sqlite_pragmas.
+        return {}
+    return {"pool_size": DATABASE_POOL_SIZE,
+            "max_overflow": DATABASE_MAX_OVERFLOW,
+            "pool_timeout": DATABASE_POOL_TIMEOUT,
+            "pool_recycle": DATABASE_POOL_RECYCLE,
+            "pool_pre_ping": True}
+
+
+
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Configures journaling, locking and syncing on each new SQLite connection."""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT:d}")
+    cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    cursor.close()
+
+
+
+@event.listens_for(Session, "after_commit")
+def run_after_commit(session):
+    """Runs the callbacks registered with after_commit once the transaction has committed."""
+    for callback, args in session.info.pop("after_commit", []):
+        callback(*args)
+
+
+
+@event.listens_for(Session, "after_rollback")
+def discard_after_commit(session):
+    """Discards the callbacks registered with after_commit when the transaction is rolled back."""
+    session.info.pop("after_commit", None)
+
+
+
+def after_commit(callback, *args):
+    """
+    Runs callback(*args) once the current transaction commits, eg. to invalidate caches,
+    so that the caches cannot be refilled from data which is not yet committed.
+    """
+    db.session.info.setdefault("after_commit", []).append((callback, args))
 
 
-database_file = "sqlite:///{}".format(os.path.join(APP_DIR,"database.db")) #Get path to database file
 
 app = Flask(__name__) #define app
 app.config["SQLALCHEMY_DATABASE_URI"] = database_file #give path of database to app
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_file)
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 app.config["MAX_CONTENT_LENGTH"] = 1000 * 1000 * MAX_UPLOAD_SIZE_MB
 db = SQLAlchemy(app) #connect to database
@@ -61,6 +125,14 @@ def user_loader(user_id):
 
 class Projects(db.Model):
     __tablename__ = "projects"
+    __table_args__ = (
+        #Dashboard listing of a user's own projects, latest first.
+        Index("ix_projects_owner_updated", "owner_id", "time_updated", "project_id"),
+        #Index page listing of public projects, latest first.
+        Index("ix_projects_public_updated", "time_updated", "project_id",
+              sqlite_where=text(f"default_access >= {CAN_VIEW}"),
+              postgresql_where=text(f"default_access >= {CAN_VIEW}")),
+    )
 
     #Columns
     project_id = Column(Integer, primary_key=True, autoincrement=True)
@@ -75,30 +147,87 @@ class Projects(db.Model):
     #Comma seperated authors
     authors = Column(Text(), default="")
     content_type = Column(Text(), default="none", nullable=False)
+    description = Column(Text(), default="")
+    #Changes whenever a new thumbnail is uploaded. None if the project has no thumbnail.
+    thumbnail_version = Column(Text())
+    #Names the current build of the webgl content, which is kept under that version. None if there is no build.
+    content_version = Column(Text())
     
     #Relationships
     user_permissions = relationship("ProjectPermissions", back_populates="project")
     share_links = relationship("ShareLinks", back_populates="project")
     comments = relationship("Comments", back_populates="project")
+    downloads = relationship("Downloads", back_populates="project")
     owner = relationship("Users", back_populates="projects_owned")
     
 
     def route(self): return f"/project/{str(self.project_id)}"
     def thumbnail_route(self): return f"/project/{self.project_id}/thumbnail"
-    def folder(self): return os.path.join(PROJECTS_FOLDER, str(self.project_id))
+
+
+    def thumbnail_variant_route(self, size, extension):
+        """
+        Returns the versioned route of a resized variant of the project's thumbnail,
+        or of the default thumbnail if the project has none.
+        """
+        if self.thumbnail_version is None:
+            return "/static/images/default_thumbnail.png"
+        return f"/project/{self.project_id}/thumbnail/{self.thumbnail_version}/{size}.{extension}"
+
+
+    def thumbnail_srcset(self, extension):
+        """Returns a srcset attribute value listing every size of the thumbnail in the given format."""
+        return ", ".join(f"{self.thumbnail_variant_route(size, extension)} {size}" for size in THUMBNAIL_SIZES)
+
+
+    def key(self, *parts):
+        """Returns the storage key of the project's files joined with parts, eg. key('thumbnail')."""
+        return storage_key("projects", self.project_id, *parts)
+
+
+    def cursor(self):
+        """Returns the cursor string marking the project's position in listings ordered by update time."""
+        return make_cursor(self.time_updated, self.project_id)
+
+
+    def webgl_version(self):
+        """Returns a string identifying the project's current webgl build, or None if there is no build."""
+        return self.content_version
+
+
+    def webgl_route(self):
+        """Returns the versioned route of the project's webgl content."""
+        version = self.webgl_version()
+        if version is None:
+            return f"/project/{self.project_id}/webgl"
+        return f"/project/{self.project_id}/build/{version}/index.html"
+
+
+    def summary(self):
+        """Returns a dictionary of the project's listing details, for json responses."""
+        return {
+            "project_id": self.project_id,
+            "name": self.name,
+            "route": self.route(),
+            "thumbnail_route": self.thumbnail_variant_route("1x", "jpg"),
+            "thumbnail_srcsets": {extension: self.thumbnail_srcset(extension) for extension in THUMBNAIL_FORMATS},
+            "description": self.get_description()[:500]
+        }
 
 
     def get_download(self, filename):
         """
-        Returns the send_from_directory file with name 'filename' if the file exists in the
-        project's downloads folder, else None.
+        Returns the file with name 'filename' of the project's downloads, sent from its blob, or None if there is no such download.
+        Downloads stored before the blob store are sent from the project's downloads.
         """
-        project_folder = self.folder()
-        download_folder = os.path.join(project_folder, "downloads")
-        file_path = os.path.join(download_folder, filename)
-        if not os.path.exists(file_path):
+        download = Downloads.query.filter_by(project_id=self.project_id, filename=filename).first()
+        if download is None:
+            return None
+        if download.blob_hash is not None:
+            return storage.send(blob_key(download.blob_hash), as_attachment=True, download_name=filename)
+        if storage.stat(self.key("downloads", filename)) is None:
             return None
-        return send_from_directory(download_folder, filename, as_attachment=True)
+        return storage.send(self.key("downloads", filename), as_attachment=True)
 
 
     def assign_project_access(self, user_id, access_level):
@@ -106,9 +235,23 @@ class Projects(db.Model):
         Assigns or modifies access level of user given by user_id to be the given access level.
         The user cannot be the owner of the project.
         Returns the modified or created ProjectPermissions object.
+        Changes are committed with the rest of the session.
         """
-        current_time = datetime.now(timezone.utc)
         existing_access = ProjectPermissions.query.filter_by(project_id=self.project_id, user_id=user_id).first()
+        user_access = self.update_project_access(user_id, access_level, existing_access)
+        db.session.flush()
+        return user_access
+
+
+    def update_project_access(self, user_id, access_level, existing_access):
+        """
+        Assigns access level to the user given by user_id, given the user's existing ProjectPermissions
+        object for the project, or None if they have none.
+        The user cannot be the owner of the project.
+        Returns the modified or created ProjectPermissions object, which is not flushed.
+        Changes are committed with the rest of the session.
+        """
+        current_time = datetime.now(timezone.utc)
         if existing_access is None:
             #Create new permission
             new_access = ProjectPermissions(project_id=self.project_id,
@@ -120,7 +263,7 @@ class Projects(db.Model):
             #Update the access level and time assigned.
             existing_access.access_level = access_level
             existing_access.time_assigned = current_time
-        db.session.commit()
+        after_commit(invalidate_access_cache, self.project_id, user_id)
         #If a permission already existed, return modified access, else return new access.
         return existing_access or new_access
     
@@ -129,12 +272,13 @@ class Projects(db.Model):
         """
         Sets the tags of the project.
         Tags are stored as a comma-separated strings from the 'tags' list.
+        Changes are committed with the rest of the session.
         """
         tag_set = set(tag.strip().lower() for tag in tags.split(","))
         if "" in tag_set:
             tag_set.remove("")
         self.tags=','.join(sorted(tag_set))
-        db.session.commit()
+        self.update_search_index()
         self.update_time()
     
 
@@ -142,12 +286,13 @@ class Projects(db.Model):
         """
         Sets the authors of the project.
         Authors are stored as a comma-separated strings from the 'authors' list.
+        Changes are committed with the rest of the session.
         """
         author_set = set(author.strip() for author in authors.split(","))
         if "" in author_set:
             author_set.remove("")
         self.authors=','.join(sorted(author_set))
-        db.session.commit()
+        self.update_search_index()
         self.update_time()   
     
 
@@ -164,83 +309,157 @@ class Projects(db.Model):
             return CAN_COMMENT
         
         #Attempt to find project access:
-        project_access = ProjectPermissions.query.filter_by(project_id=self.project_id,
-                                                                user_id=user.user_id).first()
-        if project_access is None:
+        project_access_level = permission_level(self.project_id, user.user_id)
+        if project_access_level is None:
             return max(self.student_access, self.default_access)
-        return max(self.student_access,self.default_access,project_access.access_level)
+        return max(self.student_access,self.default_access,project_access_level)
     
 
     def update_time(self):
-        """Updates last edit time of project."""
+        """
+        Updates last edit time of project.
+        Changes are committed with the rest of the session.
+        """
         current_time = get_current_time()
         self.time_updated = current_time
-        db.session.commit()
+        after_commit(invalidate_project_pages, self.project_id)
     
 
     def get_description(self):
-        """
-        Returns text from the 'description.txt' file in the project folder.
-        """
-        project_dir = self.folder()
-        description_file = os.path.join(project_dir,"description.txt")
-        if not os.path.exists(description_file):
-            return ""
-        else:
-            file = open(description_file, "r")
-            text = file.read()
-            file.close()
-            return text
+        """Returns the project's description."""
+        return self.description or ""
     
 
     def set_description(self, text):
         """
-        Writes text to 'description.txt' file in project folder.
+        Sets the project's description.
+        Changes are committed with the rest of the session, so readers never see a partial description.
         """
-        project_dir = self.folder()
-        description_file = os.path.join(project_dir,"description.txt")
-        file = open(description_file, "w")
-        file.write(text)
-        file.close()
+        self.description = text
+        self.update_search_index()
         self.update_time()      
 
 
-    def add_download_info(self, download_info):
-        """Takes  download_info 3-tuple, writes to download info file."""
+    def update_search_index(self):
+        """
+        Writes the project's name, tags, authors and description to the full-text search index.
+        Changes are committed with the rest of the session.
+        """
+        if not has_search_index():
+            return
+        self.remove_search_index()
+        db.session.execute(text("INSERT INTO projects_fts(rowid, name, tags, authors, description) "
+                                "VALUES (:project_id, :name, :tags, :authors, :description)"),
+                           {"project_id": self.project_id,
+                            "name": self.name or "",
+                            "tags": self.tags or "",
+                            "authors": self.authors or "",
+                            "description": self.get_description()})
+
+
+    def remove_search_index(self):
+        """Removes the project from the full-text search index."""
+        if not has_search_index():
+            return
+        db.session.execute(text("DELETE FROM projects_fts WHERE rowid=:project_id"),
+                           {"project_id": self.project_id})
+
+
+    def add_download_info(self, download_info, blob_hash=None):
+        """
+        Takes download_info 3-tuple (filename, username, time), and records the download,
+        whose contents are in the blob with hash blob_hash.
+        Changes are committed with the rest of the session.
+        """
         filename, username, time = download_info
-        #Format time to string
-        time = time_to_string(time)
-        project_folder = self.folder()
-        log_name = os.path.join(project_folder, "downloads.txt")
+        db.session.add(Downloads(project_id=self.project_id,
+                                 filename=filename,
+                                 username=username,
+                                 time_uploaded=time,
+                                 blob_hash=blob_hash))
+        self.update_time()
+
+
+    def add_download(self, source_path, filename, username):
+        """
+        Moves the file at source_path into the blob store,
+        and records it as a download under a unique name based on filename.
+        Returns the filename used.
+        Changes are committed with the rest of the session.
+        """
+        blob_hash = store_blob(source_path)
+        unique_filename = self.unique_download_filename(filename)
+        while True:
+            try:
+                #Inserted in a savepoint, so a name taken meanwhile only undoes this insert.
+                with db.session.begin_nested():
+                    self.add_download_info((unique_filename, username, get_current_time()), blob_hash)
+                return unique_filename
+            except IntegrityError:
+                #Another upload took the name since it was checked, so the next free name is tried.
+                taken_filename = unique_filename
+                unique_filename = self.unique_download_filename(filename)
+                if unique_filename == taken_filename:
+                    raise
+
+
+    def extract_webgl_content(self, zip_path, staging_name):
+        """
+        Extracts the zip file at zip_path into the staging folder with the given name in the uploads folder,
+        then stores it as a new build of the webgl content, under a new version, and makes it the current build.
+        The zip file is stored with the build.
+        Every file is stored in the blob store and copied from its blob into the build,
+        which on local storage is a link, so builds shared between projects are stored once.
+        If extraction fails, the new build is deleted and the current build is left unchanged.
+        Returns the version of the previous build, or None, for the caller to delete once this is committed.
+        Changes are committed with the rest of the session.
+        """
+        staging_folder = os.path.join(UPLOADS_FOLDER, staging_name)
+        version = format(time.time_ns(), "x")
+
+        #Extract files to staging folder, then store them
+        shutil.rmtree(staging_folder, ignore_errors=True)
         try:
-            download_log = open(log_name, "a")
+            zipped_file = ZipFile(zip_path, "r")
+            zipped_file.extractall(path=staging_folder)
+            zipped_file.close()
+            os.replace(zip_path, os.path.join(staging_folder, "webgl_game.zip"))
+            content_files = link_folder_to_blobs(staging_folder, self.key("builds", version))
         except:
-            return
-        download_log.write(f"{filename},{username},{time}\r\n")
+            storage.delete_prefix(self.key("builds", version))
+            raise
+        finally:
+            shutil.rmtree(staging_folder, ignore_errors=True)
+
+        old_version = self.content_version
+        self.content_version = version
+        self.set_content_files(content_files)
         self.update_time()
+        return old_version
+
+
+    def set_content_files(self, content_files):
+        """
+        Takes list of 2-tuples (path within the webgl folder, blob hash) of the project's WebGL content,
+        and replaces the record of its previous content, releasing the previous content's blobs.
+        Changes are committed with the rest of the session.
+        """
+        old_files = ContentFiles.query.filter_by(project_id=self.project_id)
+        release_blobs([content_file.blob_hash for content_file in old_files])
+        old_files.delete()
+        for path, blob_hash in content_files:
+            db.session.add(ContentFiles(project_id=self.project_id, path=path, blob_hash=blob_hash))
 
 
     def get_download_info(self):
-        """Returns set of 3-tuples, (filename, username, time) from download log."""
-        project_folder = self.folder()
-        log_name = os.path.join(project_folder, "downloads.txt")
-        try:
-            download_log = open(log_name, "r")
-        except:
-            return set()
-        
-        log_text = download_log.readlines()
-        download_log.close()
-        file_set = set()
-        for entry in log_text:
-            try:
-                filename, username, time = entry.strip().split(",")
-            except ValueError:
-                continue
-            else:
-                time = string_to_time(time)
-                file_set.add((filename, username, time))
-        return file_set
+        """
+        Returns list of 3-tuples, (filename, username, time) of the project's downloads,
+        sorted by most recent first, then alphabetical, then uploader name.
+        """
+        downloads = Downloads.query.filter_by(project_id=self.project_id).order_by(Downloads.time_uploaded.desc(),
+                                                                                   Downloads.filename,
+                                                                                   Downloads.username)
+        return [(download.filename, download.username, download.get_time_uploaded()) for download in downloads]
 
 
     def unique_download_filename(self, filename):
@@ -249,12 +468,11 @@ class Projects(db.Model):
         which does not already exist in the project's downloads folder.
         """
         new_filename = secure_filename(filename)
-        existing_filenames = set(line[0] for line in self.get_download_info())
         split_filename = filename.split(".")
         first_name = split_filename[0]
         extensions = ".".join(split_filename[1:])
         counter = 1
-        while new_filename in existing_filenames:
+        while Downloads.query.filter_by(project_id=self.project_id, filename=new_filename).first() is not None:
             new_filename = secure_filename(f"{first_name}{counter}.{extensions}")
             counter+=1
         return new_filename
@@ -262,36 +480,18 @@ class Projects(db.Model):
 
     def delete_download(self, filename):
         """
-        Attemps to delete file with name 'filename' from the project's downloads folder.
+        Attemps to delete file with name 'filename' from the project's downloads, releasing its blob.
         Returns ajax response.
+        Changes are committed with the rest of the session.
         """
-        project_folder = self.folder()
-        download_info=self.get_download_info()
-        for entry in download_info:
-            if entry[0]==filename:
-                download_info.remove(entry)
-                break
-        log_name = os.path.join(project_folder, "downloads.txt")
-
-        #Rewrite download log
-        download_log = open(log_name, "w")
-        for entry in download_info:
-            try:
-                filename, username, time = entry
-                time = time_to_string(time)
-            except ValueError:
-                continue
-            except AttributeError:
-                continue
-            else:
-                download_log.write(f"{filename},{username},{time}\r\n")
-        download_log.close()
-
-        download_folder = os.path.join(project_folder, "downloads")
-        file_path = os.path.join(download_folder, filename)
-        if not os.path.exists(file_path):
+        download = Downloads.query.filter_by(project_id=self.project_id, filename=filename).first()
+        if download is None:
             return "File not found", 404
-        os.remove(file_path)
+        if download.blob_hash is not None:
+            release_blobs([download.blob_hash])
+        else:
+            storage.delete(self.key("downloads", filename))
+        db.session.delete(download)
         self.update_time()
         return "OK"
 
@@ -299,6 +499,12 @@ class Projects(db.Model):
 
 class ProjectPermissions(db.Model):
     __tablename__ = "project_permissions"
+    __table_args__ = (
+        #Dashboard listing of projects shared with a user.
+        Index("ix_project_permissions_user_access", "user_id", "access_level"),
+        #Access level of a user for a project.
+        Index("ix_project_permissions_project_user", "project_id", "user_id"),
+    )
 
     #Columns
     access_id = Column(Integer, primary_key=True, autoincrement=True)
@@ -314,6 +520,9 @@ class ProjectPermissions(db.Model):
 
 class ShareLinks(db.Model):
     __tablename__ = "share_links"
+    __table_args__ = (
+        Index("ix_share_links_project", "project_id"),
+    )
 
     #Columns
     url_string = Column(String(SHARE_URL_SIZE), primary_key=True)
@@ -330,6 +539,10 @@ class ShareLinks(db.Model):
 
 class Comments(db.Model):
     __tablename__ = "comments"
+    __table_args__ = (
+        #Project page comments, latest first.
+        Index("ix_comments_project_time", "project_id", "time_commented", "comment_id"),
+    )
 
     #Columns
     comment_id = Column(Integer, primary_key=True, autoincrement=True)
@@ -344,12 +557,110 @@ class Comments(db.Model):
         The datetime object will be assumed to be in the timezone TIMEZONE.
         """
         return self.time_commented.replace(tzinfo=TIMEZONE)
+
+
+    def cursor(self):
+        """Returns the cursor string marking this comment's position in the project's comments."""
+        return make_cursor(self.time_commented, self.comment_id)
     
     #Relationships
     project = relationship("Projects", back_populates="comments")
     user = relationship("Users", back_populates="comments")
 
 
+class Downloads(db.Model):
+    __tablename__ = "downloads"
+    __table_args__ = (
+        Index("ix_downloads_project_filename", "project_id", "filename", unique=True),
+    )
+
+    #Columns
+    download_id = Column(Integer, primary_key=True, autoincrement=True)
+    project_id = Column(Integer, ForeignKey("projects.project_id"), nullable=False)
+    filename = Column(Text, nullable=False)
+    username = Column(Text)
+    time_uploaded = Column(DateTime)
+    #None for downloads stored in the project's downloads folder, before the blob store.
+    blob_hash = Column(String(64), ForeignKey("blobs.blob_hash"))
+
+    def get_time_uploaded(self):
+        """
+        Returns the time of upload as an aware datetime object.
+        The datetime object will be assumed to be in the timezone TIMEZONE.
+        """
+        return self.time_uploaded.replace(tzinfo=TIMEZONE)
+
+    #Relationships
+    project = relationship("Projects", back_populates="downloads")
+
+
+class Blobs(db.Model):
+    """
+    A file stored once under the SHA-256 hash of its contents,
+    shared by every download and WebGL content file with those contents.
+    Blobs left without references are deleted by the sweeper in jobs.py.
+    """
+    __tablename__ = "blobs"
+
+    #Columns
+    blob_hash = Column(String(64), primary_key=True)
+    size = Column(Integer, nullable=False)
+    ref_count = Column(Integer, nullable=False, default=0)
+    time_created = Column(DateTime)
+
+    def key(self): return blob_key(self.blob_hash)
+
+
+class ContentFiles(db.Model):
+    """A file of a project's WebGL content, linked from the project's webgl folder to its blob."""
+    __tablename__ = "content_files"
+    __table_args__ = (
+        Index("ix_content_files_project", "project_id"),
+    )
+
+    #Columns
+    content_file_id = Column(Integer, primary_key=True, autoincrement=True)
+    project_id = Column(Integer, ForeignKey("projects.project_id"), nullable=False)
+    path = Column(Text, nullable=False) #Relative to the webgl folder
+    blob_hash = Column(String(64), ForeignKey("blobs.blob_hash"), nullable=False)
+
+
+class Uploads(db.Model):
+    """A resumable upload in progress, received in chunks into a part file in UPLOADS_FOLDER."""
+    __tablename__ = "uploads"
+
+    #Columns
+    upload_id = Column(String, primary_key=True)
+    project_id = Column(Integer, ForeignKey("projects.project_id"), nullable=False)
+    user_id = Column(String, ForeignKey("users.user_id"), nullable=False)
+    upload_type = Column(Text, nullable=False) #"download" or "game"
+    filename = Column(Text)
+    total_size = Column(Integer, nullable=False)
+    time_created = Column(DateTime)
+
+    def part_path(self): return os.path.join(UPLOADS_FOLDER, f"{self.upload_id}.part")
+
+    def received_size(self):
+        """Returns the number of bytes received so far."""
+        part_path = self.part_path()
+        return os.path.getsize(part_path) if os.path.exists(part_path) else 0
+
+
+class ExtractionJobs(db.Model):
+    """A queued extraction of uploaded WebGL content, run by the worker pool in jobs.py."""
+    __tablename__ = "extraction_jobs"
+
+    #Columns
+    job_id = Column(Integer, primary_key=True, autoincrement=True)
+    project_id = Column(Integer, ForeignKey("projects.project_id"), nullable=False)
+    zip_path = Column(Text, nullable=False)
+    status = Column(Text, nullable=False, default="queued") #"queued", "running", "done" or "failed"
+    message = Column(Text, default="")
+    time_created = Column(DateTime)
+    time_started = Column(DateTime)
+    time_finished = Column(DateTime)
+
+
 class AdminView(ModelView):
     def is_accessible(self):
         """Returns whether the current user is an administrator."""
@@ -367,13 +678,94 @@ admin.add_view(AdminView(Comments, db.session))
 
 #Project Helper Functions
 
+#Cache of project permission levels across requests, keyed by (project_id, user_id).
+access_cache = LRUCache(ACCESS_CACHE_SIZE)
+NOT_CACHED = object()
+
+
+def permission_level(project_id, user_id):
+    """
+    Returns the access level of the user's ProjectPermissions for the project, or None if they have none.
+    Queries the database at most once per request, or less if the cross-request cache is enabled.
+    """
+    key = (project_id, user_id)
+    request_cache = g.setdefault("permission_levels", {}) if has_app_context() else {}
+    level = request_cache.get(key, NOT_CACHED)
+    if level is NOT_CACHED:
+        level = access_cache.get(key, NOT_CACHED)
+    if level is NOT_CACHED:
+        project_access = ProjectPermissions.query.filter_by(project_id=project_id, user_id=user_id).first()
+        level = None if project_access is None else project_access.access_level
+        access_cache.set(key, level)
+    request_cache[key] = level
+    return level
+
+
+
+def load_project_permissions(project_id, user_ids):
+    """
+    Returns a dictionary of user id to ProjectPermissions object, for those of the given users
+    with permissions for the project, loaded in one query.
+    Their permission levels are cached for the request, so their access levels need no further queries.
+    """
+    permissions = {permission.user_id: permission
+                   for permission in ProjectPermissions.query.filter(ProjectPermissions.project_id==project_id,
+                                                                     ProjectPermissions.user_id.in_(user_ids))}
+    if has_app_context():
+        request_cache = g.setdefault("permission_levels", {})
+        for user_id in user_ids:
+            permission = permissions.get(user_id)
+            request_cache[(project_id, user_id)] = None if permission is None else permission.access_level
+    return permissions
+
+
+
+def invalidate_access_cache(project_id, user_id=None):
+    """
+    Removes cached permission levels for the user and project,
+    or for every user of the project if user_id is None.
+    """
+    matches = lambda key: key[0] == project_id and (user_id is None or key[1] == user_id)
+    access_cache.remove_matching(matches)
+    if has_app_context():
+        request_cache = g.get("permission_levels", {})
+        for key in [key for key in request_cache if matches(key)]:
+            del request_cache[key]
+
+
+
+
+def share_link_is_live(current_time):
+    """Returns the condition that a share link has uses left and has not expired at current_time."""
+    return and_(or_(ShareLinks.user_limit==-1, ShareLinks.times_used<ShareLinks.user_limit),
+                or_(ShareLinks.time_expires==None, ShareLinks.time_expires>current_time))
+
+
+
+def claim_share_link(url_string, current_time):
+    """
+    Uses up one use of the share link, if it has uses left and has not expired at current_time,
+    in a single conditional update. Returns whether a use was claimed.
+    Changes are committed with the rest of the session.
+    """
+    claimed = ShareLinks.query.filter(ShareLinks.url_string==url_string,
+                                      share_link_is_live(current_time)
+                                      ).update({ShareLinks.times_used: ShareLinks.times_used + 1},
+                                               synchronize_session=False)
+    return claimed == 1
+
+
+
 def create_project(name,
                    owner_id,
                    content_type="none",
                    default_access=PROJECT_DEFAULT_ACCESS,
                    student_access=PROJECT_STUDENT_ACCESS,
                    class_access=PROJECT_CLASS_ACCESS):
-    """Creates and returns a Project Object with the given parameters"""
+    """
+    Creates and returns a Project Object with the given parameters.
+    Changes are committed with the rest of the session.
+    """
     current_time = datetime.now(timezone.utc)
     new_project = Projects(name=name,
                            owner_id=owner_id,
@@ -383,19 +775,99 @@ def create_project(name,
                            default_access=default_access,
                            student_access=student_access)
     db.session.add(new_project)
-    db.session.commit()
+    #Flush to assign the project id.
+    db.session.flush()
     owner_access_level = ProjectPermissions(user_id=owner_id,
                                                 project_id=new_project.project_id,
                                                 access_level=OWNER,
                                                 time_assigned=current_time)
-    project_folder = os.path.join(PROJECTS_FOLDER,str(new_project.project_id))
-    os.mkdir(project_folder)
     db.session.add(owner_access_level)
-    db.session.commit()
+    new_project.update_search_index()
     return new_project
 
 
 
+def delete_project(project):
+    """
+    Deletes the project, the rows which belong to it, and its search index entry,
+    and releases the blobs of its downloads and content.
+    The project's files are left for the caller to remove.
+    Changes are committed with the rest of the session.
+    """
+    project.remove_search_index()
+    download_blobs = db.session.query(Downloads.blob_hash).filter(Downloads.project_id == project.project_id,
+                                                                  Downloads.blob_hash != None)
+    content_blobs = db.session.query(ContentFiles.blob_hash).filter_by(project_id=project.project_id)
+    release_blobs([blob_hash for (blob_hash,) in download_blobs.union_all(content_blobs)])
+    for model in [ProjectPermissions, Comments, ShareLinks, Downloads, ContentFiles, Uploads, ExtractionJobs]:
+        model.query.filter_by(project_id=project.project_id).delete()
+    db.session.delete(project)
+    after_commit(invalidate_access_cache, project.project_id)
+    after_commit(invalidate_project_pages, project.project_id)
+
+
+
+def blob_key(blob_hash):
+    """Returns the storage key of the blob with the given hash, in a folder named by the hash's first two characters."""
+    return storage_key("blobs", blob_hash[:2], blob_hash)
+
+
+
+def store_blob(source_path):
+    """
+    Moves the local file at source_path into the blob store, or deletes it if a blob with the same contents
+    is already stored, and adds a reference to the blob. Returns the blob's hash.
+    Changes are committed with the rest of the session.
+    """
+    blob_hash = file_hash(source_path)
+    size = os.path.getsize(source_path)
+    try:
+        #Touching the stored blob keeps the sweeper from deleting it before this reference is committed.
+        storage.touch(blob_key(blob_hash))
+        os.remove(source_path)
+    except FileNotFoundError:
+        storage.save_file(blob_key(blob_hash), source_path)
+    insert = postgresql_insert if db.engine.dialect.name == "postgresql" else sqlite_insert
+    blobs = Blobs.__table__
+    db.session.execute(insert(blobs)
+                       .values(blob_hash=blob_hash, size=size, ref_count=1, time_created=get_current_time())
+                       .on_conflict_do_update(index_elements=[blobs.c.blob_hash],
+                                              set_={"ref_count": blobs.c.ref_count + 1}))
+    return blob_hash
+
+
+
+def release_blobs(blob_hashes):
+    """
+    Removes a reference to the blob of each hash given, so a hash given twice loses two references.
+    Blobs left without references are deleted by the sweeper.
+    Changes are committed with the rest of the session.
+    """
+    for blob_hash, count in Counter(blob_hashes).items():
+        Blobs.query.filter_by(blob_hash=blob_hash).update({Blobs.ref_count: Blobs.ref_count - count},
+                                                          synchronize_session=False)
+
+
+
+def link_folder_to_blobs(folder, prefix):
+    """
+    Moves every file in the local folder into the blob store, and copies each blob to the key under prefix
+    given by the file's path within folder. On local storage the copies are hard links to the blobs.
+    Returns list of 2-tuples (path relative to folder, blob hash).
+    Changes are committed with the rest of the session.
+    """
+    content_files = []
+    for directory, subdirectories, filenames in os.walk(folder):
+        for filename in filenames:
+            file_path = os.path.join(directory, filename)
+            path = os.path.relpath(file_path, folder).replace(os.sep, "/")
+            blob_hash = store_blob(file_path)
+            storage.copy(blob_key(blob_hash), storage_key(prefix, path))
+            content_files.append((path, blob_hash))
+    return content_files
+
+
+
 def handle_project_id_string(project_id_string, threshold_access=CAN_VIEW):
     """Takes project id string, and a threshold access the user must meet,
     and returns a 3-tuple (project object, access_level of user, whether user is logged in)"""
@@ -417,4 +889,162 @@ def handle_project_id_string(project_id_string, threshold_access=CAN_VIEW):
         if access_level < threshold_access:
             #Access denied
             abort(403)
-        return (project, access_level, is_logged_in)
\ No newline at end of file
+        return (project, access_level, is_logged_in)
+
+
+#Project listings
+
+def public_projects_query():
+    """Returns a query of projects anyone may view."""
+    return Projects.query.filter(Projects.default_access>=CAN_VIEW)
+
+
+
+def owned_projects_query(user_id):
+    """Returns a query of projects owned by the user."""
+    return Projects.query.filter(Projects.owner_id==user_id)
+
+
+
+def shared_projects_query(user_id):
+    """Returns a query of projects shared with the user, excluding projects they own."""
+    #The permissions are found by index, but are sorted by their projects' update times,
+    #which no index on project_permissions can hold, so each page sorts all of the user's shares.
+    #This stays cheap for the few hundred shares a user has, and would need the update time copied
+    #into project_permissions, and kept in step on every update, to avoid.
+    return Projects.query.join(ProjectPermissions).filter(ProjectPermissions.user_id==user_id,
+                                                          CAN_VIEW <= ProjectPermissions.access_level,
+                                                          ProjectPermissions.access_level < OWNER)
+
+
+
+def paginate_query(query, cursor=None, page_size=PROJECT_PAGE_SIZE):
+    """
+    Takes a Projects query, the cursor string of the last project on the previous page, and a page size,
+    and returns the query for the next page, with one extra project to show whether another page exists.
+    Projects are ordered by latest update first, then by latest created.
+    """
+    position = read_cursor(cursor)
+    if position is not None:
+        time_updated, project_id = position
+        query = query.filter(or_(Projects.time_updated < time_updated,
+                                 and_(Projects.time_updated == time_updated, Projects.project_id < project_id)))
+    query = query.order_by(Projects.time_updated.desc(), Projects.project_id.desc())
+    return query.limit(page_size + 1)
+
+
+
+def paginate_projects(query, cursor=None, page_size=PROJECT_PAGE_SIZE):
+    """
+    Takes a Projects query, the cursor string of the last project on the previous page, and a page size,
+    and returns a 2-tuple (list of projects, cursor string for the next page or None if there are no more).
+    """
+    projects = paginate_query(query, cursor, page_size).all()
+    if len(projects) > page_size:
+        return (projects[:page_size], projects[page_size - 1].cursor())
+    return (projects, None)
+
+
+
+def comments_page_query(project_id, cursor=None, page_size=COMMENT_PAGE_SIZE):
+    """
+    Takes a project id, the cursor string of the last comment on the previous page, and a page size,
+    and returns the query for the next page of the project's comments, latest first, with their users loaded,
+    and with one extra comment to show whether another page exists.
+    """
+    query = Comments.query.options(joinedload(Comments.user)).filter(Comments.project_id==project_id)
+    position = read_cursor(cursor)
+    if position is not None:
+        time_commented, comment_id = position
+        query = query.filter(or_(Comments.time_commented < time_commented,
+                                 and_(Comments.time_commented == time_commented, Comments.comment_id < comment_id)))
+    query = query.order_by(Comments.time_commented.desc(), Comments.comment_id.desc())
+    return query.limit(page_size + 1)
+
+
+
+def paginate_comments(project_id, cursor=None, page_size=COMMENT_PAGE_SIZE):
+    """
+    Takes a project id, the cursor string of the last comment on the previous page, and a page size,
+    and returns a 2-tuple (list of comments, cursor string for the next page or None if there are no more).
+    """
+    comments = comments_page_query(project_id, cursor, page_size).all()
+    if len(comments) > page_size:
+        return (comments[:page_size], comments[page_size - 1].cursor())
+    return (comments, None)
+
+
+
+#Full-text search
+
+#Lightweight table construct for joining the fts5 search table to projects.
+projects_fts = table("projects_fts", column("rowid"))
+
+#Column weights for ranking: name, tags, authors, description.
+SEARCH_RANK = "bm25(projects_fts, 10.0, 5.0, 5.0, 1.0)"
+
+
+def has_search_index():
+    """
+    Returns whether the database has the fts5 search table, which only SQLite provides.
+    Other databases are searched without an index.
+    """
+    return db.engine.dialect.name == "sqlite"
+
+
+
+def create_search_index():
+    """
+    Creates the full-text search table if it does not exist,
+    and fills it from the projects table if it is empty.
+    """
+    if not has_search_index():
+        return
+    db.session.execute(text("CREATE VIRTUAL TABLE IF NOT EXISTS projects_fts "
+                            "USING fts5(name, tags, authors, description, tokenize='unicode61 remove_diacritics 2')"))
+    index_size = db.session.execute(text("SELECT count(*) FROM projects_fts")).scalar()
+    if index_size == 0:
+        #Descriptions are indexed once they are moved into the projects table.
+        db.session.execute(text("INSERT INTO projects_fts(rowid, name, tags, authors, description) "
+                                "SELECT project_id, coalesce(name, ''), coalesce(tags, ''), coalesce(authors, ''), '' "
+                                "FROM projects"))
+    db.session.commit()
+
+
+
+def search_query(search_text, is_logged_in):
+    """
+    Returns a query of projects visible to the user which match the search text.
+    Each word of the search text matches as a prefix, and results are ranked by relevance.
+    An empty search lists all visible projects alphabetically.
+    """
+    if is_logged_in:
+        query = Projects.query.filter(or_(Projects.student_access>=CAN_VIEW, Projects.default_access>=CAN_VIEW))
+    else:
+        query = Projects.query.filter(Projects.default_access>=CAN_VIEW)
+
+    match = search_match_string(search_text)
+    if match is None:
+        return query.order_by(Projects.name, Projects.time_updated.desc())
+    if not has_search_index():
+        #Every word must appear in the name, tags, authors or description.
+        for word in search_text.split():
+            pattern = "%{}%".format(word.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_"))
+            query = query.filter(or_(*[searched_column.ilike(pattern, escape="\\")
+                                       for searched_column in [Projects.name, Projects.tags,
+                                                               Projects.authors, Projects.description]]))
+        return query.order_by(Projects.name, Projects.time_updated.desc())
+    query = query.join(projects_fts, projects_fts.c.rowid==Projects.project_id)
+    query = query.filter(text("projects_fts MATCH :match").bindparams(match=match))
+    return query.order_by(text(SEARCH_RANK), Projects.time_updated.desc())
+
+
+
+def search_projects(search_text, is_logged_in, page=0, page_size=SEARCH_PAGE_SIZE):
+    """
+    Takes search text, whether the user is logged in, and a page number,
+    and returns a 2-tuple (list of visible projects matching the search, whether there are more results).
+    """
+    #Fetch one extra result to find whether another page exists.
+    results = search_query(search_text, is_logged_in).offset(page * page_size).limit(page_size + 1).all()
+    return (results[:page_size], len(results) > page_size)
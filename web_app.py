@@ -5,9 +5,12 @@ This document contains app routes and initialisation.
 """
 
 import os
-import shutil
-from zipfile import ZipFile, is_zipfile
+import time
+import mimetypes
+import csv
+from zipfile import is_zipfile
 
+from flask import jsonify, Response
 from secrets import compare_digest, token_urlsafe
 from passlib.hash import bcrypt
 from werkzeug.utils import secure_filename
@@ -24,6 +27,12 @@ from access_names import *
 from constants import *
 from tables import *
 from helper_functions import *
+from migrations import migrate
+from jobs import queue_extraction, resume_extraction_jobs, queue_thumbnails, remove_later, start_sweeper
+from page_cache import page_cache, project_page_group, invalidate_project_pages
+from storage import storage, storage_key
+from events import get_event_bus, project_channel
+from login_provider import get_login_provider, get_google_provider_cfg, run_login_exchange, LoginBusy
 
 
 client = WebApplicationClient(GOOGLE_CLIENT_ID)
@@ -36,12 +45,23 @@ def index():
     """
     is_logged_in = current_user.is_authenticated
     user = current_user if is_logged_in else None
+    #Arguments are normalised first, so that arbitrary query strings share the cached pages they mean.
+    cursor = normalise_cursor(request.args.get("cursor"))
+    page_size = parse_page_size(request.args.get("page_size"))
+    #The page differs between visitors only in the header, so is cached per visitor.
+    page_key = (current_user.user_id if is_logged_in else None, cursor, page_size)
+    page = page_cache.get("index", page_key)
+    if page is not None:
+        return page
     #Filter projects by public projects and sort by activity: latest first.
-    public_projects = Projects.query.filter(Projects.default_access>=CAN_VIEW).order_by(Projects.time_updated.desc()).all()
-    return render_template("index.html",
+    public_projects, next_cursor = paginate_projects(public_projects_query(), cursor, page_size)
+    page = render_template("index.html",
                            is_logged_in=is_logged_in,
                            user=user,
-                           public_projects=public_projects)
+                           public_projects=public_projects,
+                           next_cursor=next_cursor)
+    page_cache.set("index", page_key, page)
+    return page
 
 
 
@@ -72,50 +92,71 @@ login_manager.login_view = "login"
 
 
 
-@app.route("/login/callback")
-def login_callback():
+def exchange_login_code(authorization_response, redirect_url, code):
     """
-    Log user in once they are verified by google.
+    Exchanges the authorization code sent back by Google for tokens,
+    then returns the user's profile from Google as a dictionary.
+    Makes no use of the request context, so it may run on the login pool.
     Code taken from 'https://realpython.com/flask-google-login/'
     """
-    # Get authorization code Google sent back to you
-    code = request.args.get("code")
+    provider = get_login_provider()
+    #Each login has its own client, as the client holds the login's tokens.
+    login_client = WebApplicationClient(GOOGLE_CLIENT_ID)
     # Find out what URL to hit to get tokens that allow you to ask for
     # things on behalf of a user
-    google_provider_cfg = get_google_provider_cfg()
+    google_provider_cfg = provider.get_config()
     token_endpoint = google_provider_cfg["token_endpoint"]
     # Prepare and send a request to get tokens! Yay tokens!
-    token_url, headers, body = client.prepare_token_request(
+    token_url, headers, body = login_client.prepare_token_request(
         token_endpoint,
-        authorization_response=request.url,
-        redirect_url=request.base_url,
+        authorization_response=authorization_response,
+        redirect_url=redirect_url,
         code=code
     )
-    token_response = requests.post(
+    token_response = provider.exchange_code(
         token_url,
-        headers=headers,
-        data=body,
+        headers,
+        body,
         auth=(GOOGLE_CLIENT_ID, GOOGLE_CLIENT_SECRET),
     )
 
     # Parse the tokens!
-    client.parse_request_body_response(json.dumps(token_response.json()))
+    login_client.parse_request_body_response(json.dumps(token_response))
     # Now that you have tokens (yay) let's find and hit the URL
     # from Google that gives you the user's profile information,
     # including their Google profile image and email
     userinfo_endpoint = google_provider_cfg["userinfo_endpoint"]
-    uri, headers, body = client.add_token(userinfo_endpoint)
-    userinfo_response = requests.get(uri, headers=headers, data=body)
+    uri, headers, body = login_client.add_token(userinfo_endpoint)
+    return provider.get_userinfo(uri, headers, body)
+
+
+
+@app.route("/login/callback")
+def login_callback():
+    """
+    Log user in once they are verified by google.
+    Code taken from 'https://realpython.com/flask-google-login/'
+    """
+    # Get authorization code Google sent back to you
+    code = request.args.get("code")
+    # Exchange the code for the user's profile on the login pool,
+    # which limits how many logins wait on Google at once.
+    try:
+        userinfo = run_login_exchange(exchange_login_code, request.url, request.base_url, code)
+    except LoginBusy:
+        return "Too many people are logging in. Please try again in a few seconds.", 503, {"Retry-After": str(LOGIN_RETRY_AFTER)}
+    except requests.RequestException:
+        return "Could not reach Google. Please try again.", 502
     # You want to make sure their email is verified.
     # The user authenticated with Google, authorized your
     # app, and now you've verified their email through Google!
-    if userinfo_response.json().get("email_verified"):
-        unique_id = userinfo_response.json()["sub"]
-        users_email = userinfo_response.json()["email"]
+    if userinfo.get("email_verified"):
+        unique_id = userinfo["sub"]
+        users_email = userinfo["email"]
         if users_email.split("@")[1] not in ALLOWED_EMAIL_DOMAINS:
             return "Please log in with a school account.", 400
-        picture = userinfo_response.json()["picture"]
-        users_name = userinfo_response.json()["name"]
+        picture = userinfo["picture"]
+        users_name = userinfo["name"]
     else:
         return "User email not available or not verified by Google.", 400
 
@@ -160,18 +201,10 @@ def dashboard():
     Restrictions: Authenticated
     """
     user_id = current_user.get_id()
-    projects_owned = current_user.projects_owned
-    #Sort projects by latest first
-    projects_owned.sort(key=lambda x:x.time_updated, reverse=True)
-
-    #Filter project permissions for shared projects
-    projects_shared = ProjectPermissions.query.filter(ProjectPermissions.user_id==user_id, CAN_VIEW <= ProjectPermissions.access_level, ProjectPermissions.access_level< OWNER).all()
-
-    #Extract projects from project permissions
-    projects_shared = [project_access.project for project_access in projects_shared]
-
-    #Sort projects by latest first
-    projects_shared.sort(key=lambda x:x.time_updated, reverse=True)
+    page_size = parse_page_size(request.args.get("page_size"))
+    #Projects are sorted latest first, further pages are loaded by the listing route.
+    projects_owned, owned_cursor = paginate_projects(owned_projects_query(user_id), page_size=page_size)
+    projects_shared, shared_cursor = paginate_projects(shared_projects_query(user_id), page_size=page_size)
 
     #Public projects
     #other_projects = Projects.query.filter(or_(Projects.default_access >= CAN_VIEW,Projects.student_access >= CAN_VIEW)).order_by(Projects.time_updated.desc()).all()
@@ -179,39 +212,61 @@ def dashboard():
                            user=current_user,
                            projects_owned=projects_owned,
                            projects_shared = projects_shared,
+                           owned_cursor=owned_cursor,
+                           shared_cursor=shared_cursor,
                            #other_projects = other_projects,
                            is_logged_in=True)
 
 
 
+@app.route("/projects/<listing>")
+def project_listing(listing):
+    """
+    Returns a json page of projects following the given cursor, for infinite scrolling.
+    Listing is one of 'public', or 'owned' and 'shared' for the current user.
+    Restrictions: None ('owned' and 'shared': Authenticated)
+    """
+    if listing == "public":
+        query = public_projects_query()
+    elif not current_user.is_authenticated:
+        abort(401)
+    elif listing == "owned":
+        query = owned_projects_query(current_user.get_id())
+    elif listing == "shared":
+        query = shared_projects_query(current_user.get_id())
+    else:
+        abort(404)
+    projects, next_cursor = paginate_projects(query,
+                                              request.args.get("cursor"),
+                                              parse_page_size(request.args.get("page_size")))
+    return jsonify(projects=[project.summary() for project in projects],
+                   next_cursor=next_cursor)
+
+
+
 @app.route("/search")
 def search():
     """
     Route for search querys.
-    Displays list of projects partially matching the query.
+    Displays a page of projects matching the query, ranked by relevance.
     Restrictions: None
     """
     is_logged_in = current_user.is_authenticated
     user = current_user if is_logged_in else None
-    search_text = request.args.get("search","").strip().lower()
-    #Get public projects
-    if is_logged_in:
-        public_projects = Projects.query.filter(or_(Projects.student_access>=CAN_VIEW, Projects.default_access>=CAN_VIEW)).all()
-    else:
-        public_projects = Projects.query.filter(Projects.default_access>=CAN_VIEW).all()
-    results=[]
-    #Filter results
-    for project in public_projects:
-        if search_text in str(project.name).lower() or search_text in str(project.tags).lower():
-            results.append(project)
-    #Sort results by alphabetical order, then latest first.
-    results.sort(key=lambda x:x.time_updated, reverse=True)
-    results.sort(key=lambda x:x.name)
+    search_text = request.args.get("search","").strip()
+    try:
+        page = max(0, int(request.args.get("page", 0)))
+    except ValueError:
+        page = 0
+    results, has_more = search_projects(search_text, is_logged_in, page)
 
     return render_template("search.html",
                            is_logged_in=is_logged_in,
                            user=user,
-                           results=results)
+                           results=results,
+                           search_text=search_text,
+                           page=page,
+                           has_more=has_more)
 
 
 
@@ -226,11 +281,27 @@ def newProject():
         name = request.form.get("name","Untitled Project")
         owner_id = current_user.user_id
         new_project = create_project(name,owner_id)
+        db.session.commit()
         return redirect("/project/{}".format(new_project.project_id))
     return render_template("newProject.html", user=current_user, is_logged_in=True)
 
 
 
+def project_page_key(project, access_level, is_logged_in):
+    """
+    Returns the key the project page is cached under for the current user,
+    or None if the page may not be cached as the user can edit or moderate it.
+    """
+    if access_level >= CAN_EDIT:
+        return None
+    if is_logged_in and current_user.site_access >= MOD:
+        return None
+    return (str(project.time_updated),
+            access_level,
+            current_user.user_id if is_logged_in else None)
+
+
+
 @app.route("/project/<project_id_string>", methods=["GET", "POST"])
 def project(project_id_string):
     """
@@ -243,14 +314,20 @@ def project(project_id_string):
     project, access_level, is_logged_in=handle_project_id_string(project_id_string,CAN_VIEW)
     if project is None:
         abort(404)
+    page_key = project_page_key(project, access_level, is_logged_in)
+    if page_key is not None:
+        page = page_cache.get(project_page_group(project.project_id), page_key)
+        if page is not None:
+            return page
     route=f"/project/{project.project_id}"
-    download_info = list(project.get_download_info())
+    download_info = project.get_download_info()
     current_time=get_current_time()
-    #Sort download info by most recent first, then alphabetical, then uploader name
-    download_info.sort(key=lambda x:(current_time-x[2],x[0],x[1]))
     #Change time field to time difference string
     download_info =[(filename, name, format_time_delta(current_time-time)) for filename, name, time in download_info]
-    share_links = ShareLinks.query.filter(ShareLinks.project_id==project.project_id, ShareLinks.access_level_granted<=access_level)
+    share_links = ShareLinks.query.filter(ShareLinks.project_id==project.project_id,
+                                          ShareLinks.access_level_granted<=access_level,
+                                          share_link_is_live(current_time))
+    comments, comments_cursor = paginate_comments(project.project_id)
     base_template_args = {
         "is_logged_in": is_logged_in,
         "user": (current_user if is_logged_in else None),
@@ -269,15 +346,19 @@ def project(project_id_string):
         "description": project.get_description(),
         "download_info": download_info,
         "share_links": share_links,
-        "comments": project.comments,
+        "comments": comments,
+        "comments_cursor": comments_cursor,
         "access_from_string": access_from_string,
         "access_descriptions": access_descriptions,
         "user_permissions": project.user_permissions
     }
     content_type=project.content_type
-    return render_template("content/game.html",
+    page = render_template("content/game.html",
                            **base_template_args,
                            **project_template_args)
+    if page_key is not None:
+        page_cache.set(project_page_group(project.project_id), page_key, page)
+    return page
 
 
 
@@ -297,17 +378,32 @@ def deleteProject():
     if project is None:
         abort(404)
 
-    db.session.delete(project)
+    project_prefix = project.key()
+    delete_project(project)
     db.session.commit()
-
-    project_folder = project.folder()
-    shutil.rmtree(project_folder)
+    #The files are deleted in the background.
+    remove_later(project_prefix)
 
     return redirect(url_for("dashboard"))
 
 
 
 
+def set_cache_scope(response, is_public):
+    """
+    Lets shared caches, such as CDNs, store the response only if it is public,
+    and otherwise only the user's browser. Cacheable responses are sent marked public,
+    so private ones have that removed.
+    """
+    if is_public:
+        response.cache_control.private = None
+        response.cache_control.public = True
+    else:
+        response.cache_control.public = None
+        response.cache_control.private = True
+
+
+
 @app.route("/project/<project_id_string>/thumbnail")
 def thumbnail(project_id_string):
     """
@@ -317,12 +413,33 @@ def thumbnail(project_id_string):
     project, access_level, is_logged_in=handle_project_id_string(project_id_string, CAN_VIEW)
     if project is None:
         abort(404)
-    #Check for thumbnails in project folder.
-    for extension in THUMBNAIL_EXTENSIONS:
-        if os.path.exists(f"projects/{project.project_id}/thumbnail"):
-            return send_from_directory(f"projects/{project.project_id}","thumbnail")
+    #Check for thumbnail in the project's files.
+    if storage.stat(project.key("thumbnail")) is not None:
+        return storage.send(project.key("thumbnail"))
     #Return default thumbnail if thumbnail not found
-    return send_from_directory(f"static/images","default_thumbnail.png")
+    return send_from_directory(os.path.join(APP_DIR, "static", "images"), "default_thumbnail.png")
+
+
+
+@app.route("/project/<project_id_string>/thumbnail/<version>/<size>.<extension>")
+def thumbnail_variant(project_id_string, version, size, extension):
+    """
+    Returns a resized variant of the project's thumbnail, cached indefinitely,
+    or the original thumbnail if the variant has not been generated.
+    Restrictions: CAN_VIEW
+    """
+    project, access_level, is_logged_in=handle_project_id_string(project_id_string, CAN_VIEW)
+    if project is None:
+        abort(404)
+    if size not in THUMBNAIL_SIZES or extension not in THUMBNAIL_FORMATS:
+        abort(404)
+    variant_key = project.key("thumbnails", version, f"{size}.{extension}")
+    if version != project.thumbnail_version or storage.stat(variant_key) is None:
+        return thumbnail(project_id_string)
+    response = storage.send(variant_key, max_age=THUMBNAIL_CACHE_MAX_AGE)
+    response.cache_control.immutable = True
+    set_cache_scope(response, project.default_access >= CAN_VIEW)
+    return response
 
 
 
@@ -347,6 +464,8 @@ def comment(project_id_string):
                                text=new_comment_text)
         db.session.add(new_comment)
         db.session.commit()
+        invalidate_project_pages(project.project_id)
+        publish_comment(new_comment, route)
         return render_template( "ajax_responses/comment.html",
                                 comment=new_comment,
                                 current_time=get_current_time(),
@@ -359,6 +478,87 @@ def comment(project_id_string):
 
 
 
+def publish_comment(comment, route):
+    """
+    Publishes a new comment to the project's live events.
+    The comment is rendered both with and without the moderator's remove button.
+    """
+    comment_html = {}
+    for viewer, site_access in [("html", NORMAL), ("moderator_html", MOD)]:
+        comment_html[viewer] = render_template("ajax_responses/comment.html",
+                                               comment=comment,
+                                               current_time=get_current_time(),
+                                               site_access=site_access,
+                                               format_time_delta=format_time_delta,
+                                               route=route)
+    get_event_bus().publish(project_channel(comment.project_id), "comment",
+                            {"comment_id": comment.comment_id, **comment_html})
+
+
+
+@app.route("/project/<project_id_string>/events")
+def events(project_id_string):
+    """
+    Streams new and removed comments on the project as Server-Sent Events.
+    Sends a 'reset' event if the client falls behind, after which it should fetch the comments again.
+    Visitors who are not logged in poll for comments instead, so do not hold a worker thread each.
+    Restrictions: CAN_VIEW, logged in
+    """
+    project, access_level, is_logged_in=handle_project_id_string(project_id_string, CAN_VIEW)
+    if project is None:
+        abort(404)
+    if not is_logged_in:
+        return "Live comments are only streamed to logged in users.", 403
+    event_bus = get_event_bus()
+    if event_bus.subscription_count() >= EVENT_MAX_STREAMS:
+        return "Too many live connections.", 503, {"Retry-After": str(EVENT_RETRY // 1000)}
+    is_moderator = is_logged_in and current_user.site_access >= MOD
+    channel = project_channel(project.project_id)
+    subscription = event_bus.subscribe(channel)
+
+    def stream():
+        try:
+            yield f"retry: {EVENT_RETRY}\n\n"
+            while True:
+                event = subscription.get(EVENT_KEEPALIVE)
+                if event is None:
+                    yield ": keep-alive\n\n"
+                    continue
+                event_type, data = event
+                if event_type == "comment":
+                    data = {"comment_id": data["comment_id"],
+                            "html": data["moderator_html" if is_moderator else "html"]}
+                yield f"event: {event_type}\ndata: {json.dumps(data)}\n\n"
+        finally:
+            event_bus.unsubscribe(channel, subscription)
+
+    return Response(stream(),
+                    mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+
+@app.route("/project/<project_id_string>/comments")
+def comments(project_id_string):
+    """
+    Returns JSON of the next page of the project's comments after the given cursor,
+    with the comments as HTML, and the cursor of the page after or null if there are no more.
+    Restrictions: CAN_VIEW
+    """
+    project, access_level, is_logged_in=handle_project_id_string(project_id_string, CAN_VIEW)
+    if project is None:
+        abort(404)
+    comments, next_cursor = paginate_comments(project.project_id, request.args.get("cursor"))
+    comments_html = render_template("ajax_responses/comments.html",
+                                    comments=comments,
+                                    current_time=get_current_time(),
+                                    site_access=(current_user.site_access if is_logged_in else NORMAL),
+                                    format_time_delta=format_time_delta,
+                                    route=f"/project/{project.project_id}")
+    return jsonify({"html": comments_html, "next_cursor": next_cursor})
+
+
+
 @app.route("/project/<project_id_string>/deleteComment",methods=["POST"])
 @login_required
 def deleteComment(project_id_string):
@@ -383,6 +583,9 @@ def deleteComment(project_id_string):
     if comment is not None:
         db.session.delete(comment)
         db.session.commit()
+        invalidate_project_pages(comment.project_id)
+        get_event_bus().publish(project_channel(comment.project_id), "delete_comment",
+                                {"comment_id": comment.comment_id})
     else:
         return "Comment could not be found.", 404
 
@@ -390,6 +593,51 @@ def deleteComment(project_id_string):
 
 
 
+#Upload helpers
+
+def staging_path():
+    """Returns a new unique file path in the uploads staging folder."""
+    return os.path.join(UPLOADS_FOLDER, token_urlsafe(UPLOAD_ID_SIZE) + ".part")
+
+
+
+def finish_content_upload(project, zip_path):
+    """
+    Queues the uploaded zip file at zip_path to replace the project's content.
+    Returns json response with the route to poll for the extraction's status.
+    """
+    if not is_zipfile(zip_path):
+        os.remove(zip_path)
+        db.session.commit()
+        return "WebGL content must be a zip file.", 400
+    job = queue_extraction(project, zip_path)
+    return jsonify(job_id=job.job_id,
+                   status_route=url_for("extraction_status",
+                                        project_id_string=project.project_id,
+                                        job_id=job.job_id))
+
+
+
+def finish_download_upload(project, access_level, file_path, filename):
+    """
+    Adds the uploaded file at file_path to the project's downloads.
+    Returns ajax response.
+    """
+    route = f"/project/{project.project_id}"
+    filename = project.add_download(file_path, filename, current_user.name)
+    db.session.commit()
+    return render_template( "ajax_responses/download.html",
+                            filename=filename,
+                            username=current_user.name,
+                            time="Less than a minute ago",
+                            access_level=access_level,
+                            access_from_string=access_from_string,
+                            project=project,
+                            route=route
+    )
+
+
+
 @app.route("/project/<project_id_string>/upload/content", methods=["POST"])
 @login_required
 def upload_content(project_id_string):
@@ -401,9 +649,6 @@ def upload_content(project_id_string):
     if project is None:
         abort(404)
 
-    route = f"/project/{project.project_id}"
-    project_folder = project.folder()
-
     content_type = request.form.get("type", None)
     file = request.files.get("file",None)
     if file is None or content_type is None:
@@ -411,26 +656,13 @@ def upload_content(project_id_string):
     if content_type == "game":
         if file.mimetype != "application/zip":
             return "WebGL content must be a zip file.", 400
-        webgl_folder = os.path.join(project_folder,"webgl")
-
-        #Delete contents of webgl folder
-        shutil.rmtree(webgl_folder, ignore_errors=True)
-        os.mkdir(webgl_folder)
 
         #Save zip file
-        file_path = os.path.join(webgl_folder, "webgl_game.zip")
-        file.save(file_path)
-
-        #Extract files to webgl folder
-        if is_zipfile(os.path.join(webgl_folder, "webgl_game.zip")):
-            zipped_file = ZipFile(file_path, "r")
-            zipped_file.extractall(path=webgl_folder)
-
-        project.update_time()
-
-        current_time=get_current_time().strftime("%s")
-        ajax_response= f'<iframe id="player" src="/project/{project.project_id}/webgl?t={current_time}" title="Player"></iframe>'
-        return ajax_response
+        file_path = staging_path()
+        if not save_stream(file.stream, file_path, 1000 * 1000 * MAX_CONTENT_SIZE_MB):
+            os.remove(file_path)
+            return f"File too large (Max {MAX_CONTENT_SIZE_MB}MB)", 413
+        return finish_content_upload(project, file_path)
 
     return "Unknown content type.", 400
 
@@ -446,76 +678,231 @@ def upload_download(project_id_string):
     if project is None:
         abort(404)
 
-    route = f"/project/{project.project_id}"
-    project_folder = project.folder()
     file = request.files.get("file",None)
     if file is None:
         return "Invalid input.", 400
 
-
-    #Ensure downloads folder exists
-    download_folder = os.path.join(project_folder, "downloads")
-    if not os.path.exists(download_folder):
-        os.mkdir(download_folder)
-
     filename = request.form.get("filename", None)
     filename = secure_filename(filename or file.filename)
-    filename = project.unique_download_filename(filename)
 
-    file_path = os.path.join(download_folder, filename)
-    file.save(file_path)
-    download_data = (filename, current_user.name, datetime.now(timezone.utc))
-    project.add_download_info(download_data)
+    file_path = staging_path()
+    if not save_stream(file.stream, file_path, 1000 * 1000 * MAX_DOWNLOAD_SIZE_MB):
+        os.remove(file_path)
+        return f"File too large (Max {MAX_DOWNLOAD_SIZE_MB}MB)", 413
+    return finish_download_upload(project, access_level, file_path, filename)
+
+
+
+@app.route("/project/<project_id_string>/upload/start", methods=["POST"])
+@login_required
+def start_upload(project_id_string):
+    """
+    Starts a resumable upload of a download or of playable content, to be sent in chunks.
+    Returns the upload id.
+    Restrictions: Authenticated, CAN_EDIT
+    """
+    project, access_level, is_logged_in=handle_project_id_string(project_id_string, CAN_EDIT)
+    if project is None:
+        abort(404)
+
+    upload_type = request.form.get("type", None)
+    max_size_mb = {"download": MAX_DOWNLOAD_SIZE_MB, "game": MAX_CONTENT_SIZE_MB}.get(upload_type, None)
+    if max_size_mb is None:
+        return "Unknown content type.", 400
+    try:
+        total_size = int(request.form.get("size", None))
+    except (TypeError, ValueError):
+        return "Invalid input.", 400
+    if total_size < 0:
+        return "Invalid input.", 400
+    if total_size > 1000 * 1000 * max_size_mb:
+        return f"File too large (Max {max_size_mb}MB)", 413
+    filename = secure_filename(request.form.get("filename", ""))
+    if upload_type == "download" and filename == "":
+        return "Invalid input.", 400
+
+    upload = Uploads(upload_id=token_urlsafe(UPLOAD_ID_SIZE),
+                     project_id=project.project_id,
+                     user_id=current_user.user_id,
+                     upload_type=upload_type,
+                     filename=filename,
+                     total_size=total_size,
+                     time_created=get_current_time())
+    open(upload.part_path(), "wb").close()
+    db.session.add(upload)
+    db.session.commit()
+    return upload.upload_id
+
+
+
+@app.route("/project/<project_id_string>/upload/chunk", methods=["GET", "POST"])
+@login_required
+def upload_chunk(project_id_string):
+    """
+    GET returns the number of bytes received for the upload, so that it may be resumed.
+    POST appends the request body to the upload at the given offset.
+    Once every byte is received the upload is completed,
+    and the response is the same as for uploading the file in one request.
+    Restrictions: Authenticated, CAN_EDIT, Uploader
+    """
+    project, access_level, is_logged_in=handle_project_id_string(project_id_string, CAN_EDIT)
+    if project is None:
+        abort(404)
+
+    upload = Uploads.query.filter_by(upload_id=request.args.get("upload_id", ""),
+                                     project_id=project.project_id,
+                                     user_id=current_user.user_id).first()
+    if upload is None:
+        return "Upload not found.", 404
+    received_size = upload.received_size()
+    if request.method == "GET":
+        return jsonify(received=received_size)
+
+    try:
+        offset = int(request.args.get("offset", None))
+    except (TypeError, ValueError):
+        return "Invalid input.", 400
+    if offset != received_size:
+        #Chunk is out of order: the client should resume from the received size.
+        return jsonify(received=received_size), 409
+    if not save_stream(request.stream, upload.part_path(), upload.total_size - received_size, append=True):
+        return "Upload is larger than its declared size.", 413
+
+    received_size = upload.received_size()
+    if received_size < upload.total_size:
+        return jsonify(received=received_size), 202
+
+    db.session.delete(upload)
+    if upload.upload_type == "game":
+        return finish_content_upload(project, upload.part_path())
+    return finish_download_upload(project, access_level, upload.part_path(), upload.filename)
+
+
+
+@app.route("/project/<project_id_string>/upload/status/<int:job_id>", methods=["GET"])
+@login_required
+def extraction_status(project_id_string, job_id):
+    """
+    Returns json status of an extraction of uploaded content: 'queued', 'running', 'done' or 'failed'.
+    Once done, the response includes the player to display.
+    Restrictions: Authenticated, CAN_EDIT
+    """
+    project, access_level, is_logged_in=handle_project_id_string(project_id_string, CAN_EDIT)
+    if project is None:
+        abort(404)
+    job = ExtractionJobs.query.filter_by(job_id=job_id, project_id=project.project_id).first()
+    if job is None:
+        return "Upload not found.", 404
+    player = ""
+    if job.status == "done":
+        player = f'<iframe id="player" src="{project.webgl_route()}" title="Player"></iframe>'
+    return jsonify(status=job.status, message=job.message, player=player)
+
+
+
+#WebGL helpers
+
+def send_build_file(build_prefix, file_path, is_versioned, is_public):
+    """
+    Returns a response sending a file of the webgl build stored under build_prefix, with caching headers.
+    Precompressed ('.gz' or '.br') files are sent with their content encoding,
+    and a precompressed copy of a file is sent in its place if the client accepts the encoding.
+    Files requested by build version never change, so are cached indefinitely, others must be revalidated.
+    Only files of public projects may be stored in shared caches.
+    """
+    base_path, extension = os.path.splitext(file_path)
+    encoding = BUILD_COMPRESSION_ENCODINGS.get(extension, None)
+    if encoding is None:
+        base_path = file_path
+        for extension, accepted_encoding in BUILD_COMPRESSION_ENCODINGS.items():
+            compressed_key = storage_key(build_prefix, file_path + extension)
+            if accepted_encoding in request.accept_encodings and storage.stat(compressed_key) is not None:
+                file_path = file_path + extension
+                encoding = accepted_encoding
+                break
+
+    content_type = BUILD_CONTENT_TYPES.get(os.path.splitext(base_path)[1], None)
+    if content_type is None:
+        content_type = mimetypes.guess_type(base_path)[0] or "application/octet-stream"
+    try:
+        response = storage.send(storage_key(build_prefix, file_path), mimetype=content_type,
+                                max_age=(BUILD_CACHE_MAX_AGE if is_versioned else None))
+    except FileNotFoundError:
+        abort(404)
+    if encoding is not None:
+        response.content_encoding = encoding
+    response.vary.add("Accept-Encoding")
+    if is_versioned:
+        response.cache_control.immutable = True
+    set_cache_scope(response, is_public)
+    return response
 
-    return render_template( "ajax_responses/download.html",
-                            filename=filename,
-                            username=current_user.name,
-                            time="Less than a minute ago",
-                            access_level=access_level,
-                            access_from_string=access_from_string,
-                            project=project,
-                            route=route
-    )
 
 
 @app.route("/project/<project_id_string>/webgl",methods=["GET"])
-def webGL(project_id_string):
+@app.route("/project/<project_id_string>/build/<version>/index.html",methods=["GET"])
+def webGL(project_id_string, version=None):
     """
-    Returns a send_from_directory of the webgl content ('index.html' file).
+    Returns the webgl content ('index.html' file) of the current build.
+    The unversioned route, and routes of older builds, redirect to the route of the current build version,
+    so that the build's files are requested from versioned, cacheable routes.
+    Sets a signed token cookie authorising the build's files to be loaded without database lookups.
     Restrictions: CAN_VIEW
     """
     project, access_level, is_logged_in=handle_project_id_string(project_id_string, CAN_VIEW)
     if project is None:
         abort(404)
 
-    if not os.path.exists(f"{PROJECTS_FOLDER}/{project.project_id}/webgl/index.html"):
+    current_version = project.webgl_version()
+    if current_version is None or storage.stat(project.key("builds", current_version, "index.html")) is None:
         #The game files are missing.
         return "<i>Sorry, there is nothing to display.</i>"
-    return send_from_directory(f"{PROJECTS_FOLDER}/{project.project_id}/webgl","index.html")
-    #return "Temporarily disabled"
+    if version != current_version:
+        response = redirect(project.webgl_route())
+    else:
+        response = storage.send(project.key("builds", version, "index.html"))
+        response.cache_control.no_cache = True
+    asset_token = sign_asset_token(app.secret_key, project.project_id, project.default_access >= CAN_VIEW)
+    response.set_cookie(ASSET_TOKEN_COOKIE, asset_token,
+                        max_age=ASSET_TOKEN_LIFETIME,
+                        path=f"/project/{project.project_id}/",
+                        secure=request.is_secure,
+                        httponly=True,
+                        samesite="Lax")
+    return response
 
 
 
 @app.route("/project/<project_id_string>/<folder>/<path:path>",methods=["GET"])
-def gamedata(project_id_string, folder, path):
+@app.route("/project/<project_id_string>/build/<version>/<folder>/<path:path>",methods=["GET"])
+def gamedata(project_id_string, folder, path, version=None):
     """
-    Route to serve WebGL content. Returns requested files from within webgl folder.
+    Route to serve WebGL content. Returns requested files from within the build of the given version,
+    which may be cached indefinitely, or from the current build if no version is given.
+    Requests carrying a valid asset token cookie from webGL() are served without database access.
     Restrictions: CAN_VIEW
     """
-    project, access_level, is_logged_in=handle_project_id_string(project_id_string, CAN_VIEW)
-    if project is None:
-        abort(404)
-    project_dir = project.folder()
-    content_dir = os.path.join(project_dir,"webgl")
     #Only the folders provided by the game build may be accessed.
-    if folder not in ["TemplateData", "Build"]: abort(404)
-    inner_path = os.path.realpath(os.path.join(content_dir, folder))
-    inner_path = os.path.realpath(os.path.join(inner_path, path))
-    if not inner_path.startswith(content_dir):
-        abort(403)
-    if not os.path.exists(inner_path):
-        abort(404)
-    return send_from_directory(content_dir, os.path.join(folder,path))
+    if folder not in BUILD_FOLDERS: abort(404)
+    if ".." in path.split("/") or version == "..": abort(404)
+
+    try:
+        project_id = int(project_id_string)
+    except ValueError:
+        abort(400)
+    is_public = read_asset_token(app.secret_key, project_id, request.cookies.get(ASSET_TOKEN_COOKIE))
+    if is_public is None:
+        #No valid token: check access in the database.
+        project, access_level, is_logged_in=handle_project_id_string(project_id_string, CAN_VIEW)
+        is_public = project.default_access >= CAN_VIEW
+
+    is_versioned = version is not None
+    if not is_versioned:
+        version = db.session.query(Projects.content_version).filter_by(project_id=project_id).scalar()
+        if version is None:
+            abort(404)
+    build_prefix = storage_key("projects", project_id, "builds", version)
+    return send_build_file(build_prefix, f"{folder}/{path}", is_versioned, is_public)
 
 
 
@@ -528,8 +915,6 @@ def download(project_id_string):
     project, access_level, is_logged_in=handle_project_id_string(project_id_string, CAN_VIEW)
     if project is None:
         abort(404)
-    project_dir = project.folder()
-    download_folder = os.path.join(PROJECTS_FOLDER,"downloads")
     download = project.get_download(request.form.get("filename",""))
     if download is None:
         return redirect(f"/project/{project.project_id}")
@@ -548,7 +933,9 @@ def deleteDownload(project_id_string):
     project, access_level, is_logged_in=handle_project_id_string(project_id_string, CAN_EDIT)
     if project is None:
         abort(404)
-    return project.delete_download(request.form.get("filename",""))
+    response = project.delete_download(request.form.get("filename",""))
+    db.session.commit()
+    return response
 
 
 
@@ -583,6 +970,7 @@ def projectAccess(project_id_string):
         if new_access < NO_ACCESS or new_access > SUB_OWNER:
             return "Invalid access level.", 400
         user_access = project.assign_project_access(added_user.user_id, new_access)
+        db.session.commit()
         return str(user_access.access_id) + render_template( "ajax_responses/access_row.html",
             route=route,
             access_level=access_level,
@@ -595,6 +983,108 @@ def projectAccess(project_id_string):
 
 
 
+def read_access_rows():
+    """
+    Returns a list of 2-tuples (email, access level string) from the request.
+    Accepts a JSON list of {"email", "access_level"} objects or of emails,
+    or CSV rows of email and optional access level, in the 'emails' form field or an uploaded 'file'.
+    Rows without an access level take the 'access_level' form field.
+    """
+    default_level = request.form.get("access_level", None)
+    data = request.get_json(silent=True)
+    if isinstance(data, list):
+        rows = []
+        for entry in data:
+            if isinstance(entry, dict):
+                rows.append((str(entry.get("email", "")), entry.get("access_level", default_level)))
+            else:
+                rows.append((str(entry), default_level))
+        return rows
+
+    csv_file = request.files.get("file")
+    if csv_file is not None:
+        csv_lines = csv_file.read().decode("utf-8-sig", errors="replace").splitlines()
+    else:
+        csv_lines = request.form.get("emails", "").splitlines()
+    rows = []
+    for cells in csv.reader(csv_lines):
+        cells = [cell.strip() for cell in cells]
+        if not any(cells) or cells[0].lower() == "email":
+            #Skip blank lines and headers.
+            continue
+        access_string = cells[1] if len(cells) > 1 and cells[1] != "" else default_level
+        rows.append((cells[0], access_string))
+    return rows
+
+
+
+@app.route("/project/<project_id_string>/access/bulk", methods=["POST"])
+@login_required
+def projectAccessBulk(project_id_string):
+    """
+    Sets the access of many users to the project in one transaction, eg. to share with a class.
+    Rows are checked as in projectAccess, and returns JSON of the result of each row,
+    with the HTML of the access row of each user whose access was set.
+    Rows repeating an earlier row's email are rejected.
+    Restrictions: Authenticated, SUB_OWNER
+    """
+    project, access_level, is_logged_in=handle_project_id_string(project_id_string, SUB_OWNER)
+    if project is None:
+        abort(404)
+    route = f"/project/{project.project_id}"
+    rows = read_access_rows()
+    if len(rows) == 0:
+        return "No emails given.", 400
+    if len(rows) > MAX_BULK_ACCESS_ROWS:
+        return f"At most {MAX_BULK_ACCESS_ROWS} users may be shared with at once.", 400
+
+    #Resolve every user and their existing permissions in one query each.
+    emails = set(email.strip() for email, access_string in rows)
+    users = {user.email: user for user in Users.query.filter(Users.email.in_(emails))}
+    permissions = load_project_permissions(project.project_id, [user.user_id for user in users.values()])
+
+    results = []
+    assigned = []
+    seen_emails = set()
+    for row_number, (email, access_string) in enumerate(rows, start=1):
+        email = email.strip()
+        result = {"row": row_number, "email": email, "access_level": access_string}
+        results.append(result)
+        added_user = users.get(email)
+        #JSON access levels may be any type, and only strings name a level.
+        new_access = access_from_string.get(access_string, None) if isinstance(access_string, str) else None
+        is_repeated = email in seen_emails
+        seen_emails.add(email)
+        if email == "":
+            result["error"] = "Email may not be blank."
+        elif is_repeated:
+            #Only the first row for an email is applied, so later rows cannot silently override it.
+            result["error"] = "Email already given in an earlier row."
+        elif added_user is None:
+            result["error"] = "User has not registered with that email."
+        elif project.access_level(added_user) >= access_level:
+            result["error"] = VIOLATION_ERROR[0]
+        elif new_access is None or new_access < NO_ACCESS or new_access > SUB_OWNER:
+            result["error"] = "Invalid access level."
+        else:
+            user_access = project.update_project_access(added_user.user_id, new_access,
+                                                        permissions.get(added_user.user_id))
+            permissions[added_user.user_id] = user_access
+            assigned.append((result, user_access))
+    db.session.flush()
+    for result, user_access in assigned:
+        result["access_id"] = user_access.access_id
+        result["html"] = render_template("ajax_responses/access_row.html",
+                                         route=route,
+                                         access_level=access_level,
+                                         user_access=user_access,
+                                         access_descriptions=access_descriptions,
+                                         access_from_string=access_from_string)
+    db.session.commit()
+    return jsonify(results=results, assigned=len(assigned))
+
+
+
 @app.route("/project/<project_id_string>/deleteAccess", methods=["POST"])
 @login_required
 def deleteProjectAccess(project_id_string):
@@ -609,7 +1099,9 @@ def deleteProjectAccess(project_id_string):
     if request.form:
         access_id = request.form.get("access_id", None)
         if access_id is not None:
-            existing_access = ProjectPermissions.query.filter_by(access_id=access_id).first()
+            #Scoped to the project, as the caller's access was only checked for this project.
+            existing_access = ProjectPermissions.query.filter_by(access_id=access_id,
+                                                                 project_id=project.project_id).first()
             if existing_access is None:
                 return "Permission not found.", 404
             if existing_access.access_level >= access_level:
@@ -617,6 +1109,7 @@ def deleteProjectAccess(project_id_string):
             else:
                 db.session.delete(existing_access)
                 db.session.commit()
+                invalidate_access_cache(existing_access.project_id, existing_access.user_id)
                 return "OK"
 
     return "User not found.", 404
@@ -728,16 +1221,21 @@ def invite(project_id_string, invite_string):
         abort(404)
     if share_link.project_id != project.project_id:
         abort(404)
+    #Reject used up and expired links without taking the write lock.
     if share_link.user_limit != -1 and share_link.times_used >= share_link.user_limit:
         abort(404)
-    if share_link.time_expires is not None and current_time > share_link.time_expires:
+    if share_link.time_expires is not None and current_time > share_link.time_expires.replace(tzinfo=TIMEZONE):
         abort(404)
     route = f"/project/{project.project_id}"
     existing_access = project.access_level(current_user)
     if share_link.access_level_granted <= existing_access:
         return redirect(route)
 
-    share_link.times_used += 1
+    #The use is claimed and the access granted in one transaction,
+    #so concurrent redemptions cannot exceed the link's user limit.
+    if not claim_share_link(invite_string, current_time):
+        db.session.rollback()
+        abort(404)
     project.assign_project_access(current_user.user_id, min(SUB_OWNER, share_link.access_level_granted))
     db.session.commit()
     return redirect(route)
@@ -767,6 +1265,8 @@ def simpleShare(project_id_string):
             project.default_access = CAN_VIEW
             project.student_access = CAN_COMMENT
         db.session.commit()
+        invalidate_access_cache(project.project_id)
+        invalidate_project_pages(project.project_id)
         return render_template('ajax_responses/share_info.html', project=project, access_descriptions=access_descriptions)
     else:
         return "Invalid share setting.", 400
@@ -789,6 +1289,7 @@ def editProject(project_id_string):
         title = form.get("title", "")
         if title != "":
             project.name = title
+            project.update_search_index()
             project.update_time()
             db.session.commit()
             return "OK"
@@ -796,35 +1297,38 @@ def editProject(project_id_string):
         authors = form.get("authors", "")
         if authors != "":
             project.set_authors(authors)
+            db.session.commit()
             return ", ".join(project.authors.split(","))
 
         description = form.get("description", "")
         if description != "":
             project.set_description(description)
+            db.session.commit()
             return "OK"
 
         tags = form.get("tags", "")
         if tags != "":
             project.set_tags(tags)
+            db.session.commit()
             return render_template("ajax_responses/paragraph_list.html", items=project.tags.split(","))
 
         thumbnail_file = request.files.get("thumbnail")
 
-        new_thumbnail_path = os.path.join(project.folder(), "new_thumbnail")
-        thumbnail_path = os.path.join(project.folder(), "thumbnail")
+        new_thumbnail_path = staging_path()
         if thumbnail_file is not None:
             if thumbnail_file.mimetype.split("/")[1] in THUMBNAIL_EXTENSIONS:
-                thumbnail_file.save(new_thumbnail_path)
-                #Check size:
-                thumbnail_size = os.stat(new_thumbnail_path).st_size
-                if thumbnail_size > 1000 * 1000 * MAX_THUMBNAIL_SIZE_MB:
+                #Save, stopping if the file is too large.
+                if not save_stream(thumbnail_file.stream, new_thumbnail_path, 1000 * 1000 * MAX_THUMBNAIL_SIZE_MB):
                     #Size too large: delete thumbnail file.
                     os.remove(new_thumbnail_path)
                     return f"File too large (Max {MAX_THUMBNAIL_SIZE_MB}MB)", 413
                 else:
-                    #Commit file to thumbnail
-                    os.rename(new_thumbnail_path, thumbnail_path)
+                    #Commit file to thumbnail, and resize it in the background.
+                    storage.save_file(project.key("thumbnail"), new_thumbnail_path)
+                    project.thumbnail_version = format(time.time_ns(), "x")
                     project.update_time()
+                    db.session.commit()
+                    queue_thumbnails(project)
                     return "OK"
             else:
                 #Thumbnail not saved.
@@ -841,8 +1345,13 @@ if not os.path.exists(file_location(SECRET_KEY_FILENAME)):
     generate_key(SECRET_KEY_FILENAME, 24)
 app.secret_key = get_key(SECRET_KEY_FILENAME)
 
-if not os.path.exists(file_location(database_file)):
-    db.create_all()
+if not os.path.exists(UPLOADS_FOLDER):
+    os.mkdir(UPLOADS_FOLDER)
+
+#Create or upgrade database schema
+migrate()
+resume_extraction_jobs()
+start_sweeper()
 
 
 if __name__ == "__main__":